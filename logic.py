@@ -10,10 +10,25 @@
     the operator count.
     A term is a set (type, args*) where type is the operator or "term".
 
+    Formulas may also be interned (hash-consed) to small integer IDs, so that
+    identical subformulas are stored once and can be compared and hashed in
+    constant time; a sequent is then a pair of frozensets of IDs.
+
     Author: Alastair Hughes
     Date:   6-9-2016
 """
 
+import heapq
+import json
+import os
+import re
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, wraps
+
 NOT     = '!'
 AND     = '&'
 OR      = '|'
@@ -29,6 +44,151 @@ OR_SYM      = '∨'
 IMPLY_SYM   = '→'
 TURNSTYLE   = '⊢'
 
+# Maximum number of solved sequents remembered by is_valid.
+CACHE_SIZE  = 100000
+
+# Theorems with more distinct connectives than this are sent to the SAT
+# backend by decide(theorem, backend='auto').
+SAT_THRESHOLD = 40
+
+# Largest number of distinct terms truth_table will enumerate.
+MAX_TABLE_TERMS = 24
+
+# Rule labels for the leaves of a ProofDAG; the other rules are labelled with
+# the operator symbol and the side, eg '∧L'.
+AXIOM   = 'ax'
+OPEN    = 'open'
+RULE_SYMBOLS = {NOT: NOT_SYM, AND: AND_SYM, OR: OR_SYM, IMPLY: IMPLY_SYM}
+
+# Statuses of the results from prove_batch.
+VALID   = 'valid'
+INVALID = 'invalid'
+TIMEOUT = 'timeout'
+ERROR   = 'error'
+
+# Conflicts before the first restart of the SAT solver; later restarts follow
+# the Luby sequence in multiples of this.
+RESTART_BASE = 100
+
+# Interned formulas: ID i stands for _formulas[i], with operator _ops[i] and
+# the IDs of its subformulas (or the term name) in _args[i]. _ids maps
+# (operator, arguments) back to the ID.
+_formulas = []
+_ops = []
+_args = []
+_ids = {}
+
+# Sequents solved by is_valid, mapped to whether they are valid, from least
+# to most recently used.
+_cache = {}
+
+# Counters for the current instrument() block, or None when not instrumented.
+_stats = None
+
+
+class ProverStats:
+    """ Counters collected by instrument().
+
+        rules counts the rule applications made by the sequent search (solve,
+        decide, iter_proof) by rule label, eg '∧L', and branches the number
+        of branches they produced; max_depth and peak_live are the deepest
+        rule application and the most sequents waiting to be proved at once.
+        cache_hits and cache_misses count lookups of the sequents remembered
+        by is_valid, and phases the seconds spent parsing, solving and
+        rendering.
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.branches = 0
+        self.max_depth = 0
+        self.peak_live = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.phases = {}
+        self._running = set()
+
+    def applications(self):
+        """ Return the total number of rule applications """
+
+        return sum(self.rules.values())
+
+    def branching_factor(self):
+        """ Return the mean number of branches per rule application """
+
+        applications = self.applications()
+        return self.branches / applications if applications else 0.0
+
+    def record(self):
+        """ Return the counters as a dict, suitable for json.dumps """
+
+        return {
+            'rules': dict(self.rules),
+            'applications': self.applications(),
+            'branching_factor': self.branching_factor(),
+            'max_depth': self.max_depth,
+            'peak_live': self.peak_live,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'phases': dict(self.phases),
+        }
+
+
+@contextmanager
+def instrument(emit=None):
+    """ Collect ProverStats for the work done in this process inside the
+        with block, calling emit with stats.record() at the end if given.
+        Blocks may be nested; each only counts the work done directly in it.
+
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> with instrument() as stats:
+        ...     proof = solve(({(OR, a, (AND, a, b))}, {a}))
+        >>> stats.rules, stats.max_depth, stats.branching_factor()
+        ({'∨L': 1, '∧L': 1}, 1, 1.5)
+        >>> with instrument(lambda record: print(record['peak_live'])):
+        ...     valid, model = decide(({(OR, a, b)}, {a}))
+        2
+        >>> with instrument() as outer:
+        ...     with instrument() as inner:
+        ...         valid = is_valid(({(AND, b, b)}, {b}))
+        ...     valid = is_valid(({(AND, b, b)}, {b}))
+        >>> inner.cache_misses, outer.cache_misses, outer.cache_hits
+        (2, 0, 1)
+    """
+
+    global _stats
+    stats = ProverStats()
+    previous, _stats = _stats, stats
+    try:
+        yield stats
+    finally:
+        _stats = previous
+        if emit is not None:
+            emit(stats.record())
+
+
+def _timed(phase):
+    """ Decorate a function to add its running time to the given phase of
+        the current ProverStats, if any. Nested calls are only timed once.
+    """
+
+    def decorate(function):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            stats = _stats
+            if stats is None or phase in stats._running:
+                return function(*args, **kwargs)
+            stats._running.add(phase)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.phases[phase] = stats.phases.get(phase, 0.0) + \
+                        time.perf_counter() - start
+                stats._running.discard(phase)
+        return timed
+    return decorate
+
 
 def render_theorem(theorem):
     """ Render the given theorem into a string """
@@ -38,93 +198,229 @@ def render_theorem(theorem):
             ", ".join((render_formula(formula) for formula in theorem[1]))
 
 
+# Symbol rendered between the arguments of each binary operator.
+INFIX = {AND: AND_SYM, OR: OR_SYM, IMPLY: IMPLY_SYM}
+
+
 def render_formula(formula):
-    """ Render the given formula into a string """
+    """ Render the given formula into a string.
 
-    if formula[0] == NOT:
-        return NOT_SYM + render_formula(formula[1])
-    elif formula[0] == AND:
-        return '({} {} {})'.format(render_formula(formula[1]), AND_SYM, \
-                render_formula(formula[2]))
-    elif formula[0] == OR:
-        return '({} {} {})'.format(render_formula(formula[1]), OR_SYM, \
-                render_formula(formula[2]))
-    elif formula[0] == IMPLY:
-        return '({} {} {})'.format(render_formula(formula[1]), IMPLY_SYM, \
-                render_formula(formula[2]))
-    return formula[1]
+        >>> a = (TERM, 'a')
+        >>> render_formula((IMPLY, (NOT, a), (AND, a, (OR, a, a))))
+        '(¬a → (a ∧ (a ∨ a)))'
+    """
 
+    # The stack holds formulas still to render and the strings to put
+    # between them, in reverse, so deep formulas do not recurse.
+    pieces = []
+    stack = [formula]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, str):
+            pieces.append(current)
+        elif current[0] == NOT:
+            pieces.append(NOT_SYM)
+            stack.append(current[1])
+        elif current[0] in INFIX:
+            pieces.append('(')
+            stack.extend((')', current[2],
+                ' {} '.format(INFIX[current[0]]), current[1]))
+        else:
+            pieces.append(current[1])
+    return ''.join(pieces)
 
+
+@_timed('render')
 def render_proof(proof):
-    """ Render the given proof into a string in a top-down form """
+    """ Render the given proof into a string in a top-down form.
+
+        Each branch of a split is indented by one more tab than the sequent
+        it came from.
+
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> proof = solve(({(OR, a, (AND, a, b))}, {a}))
+        >>> print(render_proof(proof).replace('\\t', '. '))
+        (a ∨ (a ∧ b)) ⊢ a
+        . a ⊢ a
+        . (a ∧ b) ⊢ a
+        . a ⊢ a
+    """
+
+    return '\n'.join(iter_render_proof(proof))
+
 
-    if len(proof) == 1:
-        return render_theorem(proof[0])
-    elif len(proof) == 2:
-        return render_theorem(proof[0]) + '\n' + render_proof(proof[1])
-    elif len(proof) == 3:
-        # TODO: This does not work as intended.
-        return render_theorem(proof[0]) + '\n' + \
-                render_proof(proof[1]) + '\t\t' + render_proof(proof[2])
+def iter_render_proof(proof):
+    """ Generate the lines of render_proof one at a time """
 
+    stack = [(proof, 0)]
+    while stack:
+        proof, indent = stack.pop()
+        yield '\t' * indent + render_theorem(proof[0])
+        if len(proof) > 2:
+            indent += 1
+        stack.extend((subproof, indent) for subproof in reversed(proof[1:]))
 
+
+@_timed('parse')
 def parse_theorem(string):
-    """ Parse a theorem from the given string """
+    """ Parse a theorem from the given string, of the form
+        "assumption, ...: result, ...". Either side may be empty.
+
+        >>> theorem = parse_theorem("a > b, a: b")
+        >>> sorted(theorem[0]), theorem[1]
+        ([('', 'a'), ('>', ('', 'a'), ('', 'b'))], {('', 'b')})
+        >>> parse_theorem(": a | !a")
+        (set(), {('|', ('', 'a'), ('!', ('', 'a')))})
+    """
 
     left, right = string.split(':')
     assump = {parse_formula(tokenise_formula(formula)) \
-            for formula in left.split(',')}
+            for formula in left.split(',') if formula.strip()}
     results = {parse_formula(tokenise_formula(formula)) \
-            for formula in right.split(',')}
+            for formula in right.split(',') if formula.strip()}
     return (assump, results)
 
 
+def parse_file(path):
+    """ Lazily parse a file with one theorem per line, as for parse_theorem.
+
+        Blank lines and lines starting with '#' are skipped, and only one
+        line is held in memory at a time.
+    """
+
+    with open(path) as f:
+        for number, line in theorem_lines(f):
+            try:
+                yield parse_theorem(line)
+            except ValueError as e:
+                raise ValueError("{}:{}: {}".format(path, number, e))
+
+
+def theorem_lines(f):
+    """ Yield (line number, line) for each line of the file holding a
+        theorem, stripped, skipping blank lines and lines starting with '#'.
+
+        >>> list(theorem_lines(["# Examples", "a: a", "", "  a, b: b"]))
+        [(2, 'a: a'), (4, 'a, b: b')]
+    """
+
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield number, line
+
+
+# Binding strength of each operator; all but → associate to the left.
+PRECEDENCE = {NOT: 4, AND: 3, OR: 2, IMPLY: 1}
+
+# Symbols accepted as alternatives for each operator.
+SYMBOLS = {NOT_SYM: NOT, AND_SYM: AND, OR_SYM: OR, IMPLY_SYM: IMPLY}
+
+TOKEN_RE = re.compile(r'[^\W\d]\w*|\S')
+
+
 def tokenise_formula(string):
-    """ Tokenise the given formula """
-    return [tok for tok in string \
-        if tok in (NOT, OR, AND, IMPLY, '(', ')') or tok.isalpha()]
+    """ Tokenise the given formula in a single pass.
+
+        Terms are runs of letters, digits and underscores starting with a
+        letter or underscore.
+
+        >>> tokenise_formula("!(ab & c1) > d")
+        ['!', '(', 'ab', '&', 'c1', ')', '>', 'd']
+        >>> tokenise_formula("¬a ∧ b")
+        ['!', 'a', '&', 'b']
+        >>> tokenise_formula("a + b")
+        Traceback (most recent call last):
+        ValueError: Unknown token '+' at 2
+    """
+
+    tokens = []
+    for match in TOKEN_RE.finditer(string):
+        token = match.group()
+        token = SYMBOLS.get(token, token)
+        if token not in PRECEDENCE and token not in '()' \
+                and not token[0].isalpha() and token[0] != '_':
+            raise ValueError("Unknown token {!r} at {}".format(token,
+                match.start()))
+        tokens.append(token)
+    return tokens
 
 
 def parse_formula(tokens):
-    """ Parse a formula from the given list of tokens """
-    result, tokens = parse_subformula(tokens)
-    if len(tokens) != 0:
-        raise ValueError("Unexpected extra tokens {}".format(tokens))
-    return result
+    """ Parse a formula from the given list of tokens.
 
+        This is an operator precedence parser driven by an explicit operator
+        stack, so it reads each token once and never recurses, however
+        deeply the formula is nested. ! binds tightest, then &, |, and >;
+        & and | associate to the left and > to the right.
 
-def parse_subformula(tokens):
-    """ Parse a formula from the given list of tokens, returning the result and
-        any unused tokens.
+        >>> parse_formula(tokenise_formula("a & b | c"))
+        ('|', ('&', ('', 'a'), ('', 'b')), ('', 'c'))
+        >>> parse_formula(tokenise_formula("a > b > c"))
+        ('>', ('', 'a'), ('>', ('', 'b'), ('', 'c')))
+        >>> parse_formula(tokenise_formula("!a & !(b | c)"))
+        ('&', ('!', ('', 'a')), ('!', ('|', ('', 'b'), ('', 'c'))))
+        >>> parse_formula(tokenise_formula("(a > b) & c"))
+        ('&', ('>', ('', 'a'), ('', 'b')), ('', 'c'))
+        >>> parse_formula(tokenise_formula("a b"))
+        Traceback (most recent call last):
+        ValueError: Expected an operator, got 'b' at 1
+        >>> parse_formula(tokenise_formula("(a"))
+        Traceback (most recent call last):
+        ValueError: Unmatched '('!
+        >>> parse_formula([])
+        Traceback (most recent call last):
+        ValueError: Expected a token, got nothing!
     """
 
-    # TODO: This is BROKEN!!!
+    operands = []
+    operators = []
 
-    if len(tokens) == 0:
-        raise ValueError("Expected a token, got nothing!")
-    
-    if tokens[0] == '(':
-        result, tokens = parse_subformula(tokens[1:])
-        if tokens[0] != ')':
-            raise ValueError("Unmatched ')'!")
-        return result, tokens[1:]
-    elif len(tokens) > 1 and tokens[0] == NOT:
-        # Special case !(); otherwise bind to !a for some term.
-        if tokens[1] == '(':
-            result, tokens = parse_subformula(tokens[1:])
-            return (NOT, result), tokens
+    def reduce():
+        op = operators.pop()
+        if op == NOT:
+            operands.append((NOT, operands.pop()))
         else:
-            return (NOT, (TERM, tokens[1])), tokens[2:]
-    elif len(tokens) > 2 and tokens[1] in (OR, AND, IMPLY):
-        first, op = tokens[:2]
-        if not first.isalpha():
-            raise ValueError("Expected term, got {}!", first)
-        result, tokens = parse_subformula(tokens[2:])
-        return (op, (TERM, first), result), tokens
-    elif tokens[0].isalpha():
-        return (TERM, tokens[0]), tokens[1:]
-    else:
-        raise ValueError("Unknown token {} at {}".format(tokens[0], tokens))
+            second = operands.pop()
+            operands.append((op, operands.pop(), second))
+
+    expect_operand = True
+    for index, token in enumerate(tokens):
+        if expect_operand:
+            if token == NOT or token == '(':
+                operators.append(token)
+            elif token in PRECEDENCE or token == ')':
+                raise ValueError("Expected a term, got {!r} at {}"\
+                        .format(token, index))
+            else:
+                operands.append((TERM, token))
+                expect_operand = False
+        elif token == ')':
+            while operators and operators[-1] != '(':
+                reduce()
+            if not operators:
+                raise ValueError("Unmatched ')'!")
+            operators.pop()
+        elif token in PRECEDENCE and token != NOT:
+            precedence = PRECEDENCE[token]
+            while operators and operators[-1] != '(' and \
+                    (PRECEDENCE[operators[-1]] > precedence or \
+                    PRECEDENCE[operators[-1]] == precedence and \
+                    token != IMPLY):
+                reduce()
+            operators.append(token)
+            expect_operand = True
+        else:
+            raise ValueError("Expected an operator, got {!r} at {}"\
+                    .format(token, index))
+
+    if expect_operand:
+        raise ValueError("Expected a token, got nothing!")
+    while operators:
+        if operators[-1] == '(':
+            raise ValueError("Unmatched '('!")
+        reduce()
+    return operands[0]
 
 
 def opcount(formula):
@@ -145,6 +441,216 @@ def opcount(formula):
         return 1 + opcount(formula[1]) + opcount(formula[2])
 
 
+def intern_formula(formula):
+    """ Return the ID of the given formula, interning it and its subformulas
+        if they have not been seen before.
+
+        >>> a = intern_formula((AND, (TERM, 'a'), (TERM, 'b')))
+        >>> a == intern_formula((AND, (TERM, 'a'), (TERM, 'b')))
+        True
+        >>> formula_of(a)
+        ('&', ('', 'a'), ('', 'b'))
+        >>> formula_of(_args[a][0])
+        ('', 'a')
+    """
+
+    # Walk the formula with an explicit stack, interning each subformula
+    # once all of its own subformulas have IDs. The table is keyed by the
+    # operator and subformula IDs, since hashing a nested tuple would take
+    # time proportional to its size.
+    seen = {} # Maps id() of each visited subformula to its ID.
+    stack = [(formula, False)]
+    while stack:
+        current, expanded = stack.pop()
+        if id(current) in seen:
+            continue
+        op = current[0]
+        if op == TERM:
+            args = current[1]
+        elif not expanded:
+            stack.append((current, True))
+            stack.extend((sub, False) for sub in current[1:])
+            continue
+        else:
+            args = tuple(seen[id(sub)] for sub in current[1:])
+        seen[id(current)] = _intern(op, args, current)
+    return seen[id(formula)]
+
+
+def _intern(op, args, formula=None):
+    """ Return the ID of the formula with the given operator and argument
+        IDs (or term name), interning it if needed.
+
+        The formula is built from its interned subformulas if not given.
+    """
+
+    key = (op, args)
+    formula_id = _ids.get(key)
+    if formula_id is None:
+        if formula is None:
+            formula = (op, args) if op == TERM else \
+                    (op,) + tuple(_formulas[arg] for arg in args)
+        formula_id = len(_formulas)
+        _ids[key] = formula_id
+        _formulas.append(formula)
+        _ops.append(op)
+        _args.append(args)
+    return formula_id
+
+
+def formula_of(formula_id):
+    """ Return the formula with the given ID """
+
+    return _formulas[formula_id]
+
+
+def intern_theorem(theorem):
+    """ Return the given theorem as a pair of frozensets of formula IDs """
+
+    return (frozenset(intern_formula(f) for f in theorem[LEFT]),
+            frozenset(intern_formula(f) for f in theorem[RIGHT]))
+
+
+@_timed('solve')
+def is_valid(theorem):
+    """ Return whether the given theorem is valid.
+
+        This is the same search as solve, but over interned sequents and
+        without building a proof, and every solved sequent is remembered
+        (up to CACHE_SIZE of them). Subgoals repeated across branches, or
+        across calls, are then only solved once.
+        decide with the sequent backend, and so prove_batch, looks up and
+        remembers whole theorems in the same cache; solve, iter_proof and
+        ProofDAG do not use it.
+
+        >>> is_valid(({(TERM, 'a')}, {(TERM, 'a')}))
+        True
+        >>> is_valid(({(TERM, 'a')}, {(TERM, 'b')}))
+        False
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> is_valid((set(), {(OR, a, (NOT, a))}))
+        True
+        >>> is_valid(({(IMPLY, a, b), a}, {b}))
+        True
+        >>> is_valid(({(OR, a, b)}, {a}))
+        False
+        >>> deep = a
+        >>> for i in range(10000):
+        ...     deep = (NOT, deep)
+        >>> is_valid(({deep}, {a}))
+        True
+    """
+
+    return _valid(intern_theorem(theorem))
+
+
+def clear_cache():
+    """ Forget all sequents remembered by is_valid """
+
+    _cache.clear()
+
+
+def _find_candidate(sides):
+    """ Return (side, ID) for some interned formula in the given sides with
+        an operator, or (None, None) if only terms remain.
+    """
+
+    for side, contents in enumerate(sides):
+        for formula_id in contents:
+            if _ops[formula_id] != TERM:
+                return side, formula_id
+    return None, None
+
+
+def _branches(sequent):
+    """ Apply one rule to the interned sequent, returning whether it is valid
+        if no rule applies, or else the list of sequents to prove instead.
+    """
+
+    left, right = sequent
+    if not left.isdisjoint(right):
+        # Some formula is on both sides, so the sequent is an axiom.
+        return True
+    sides = [left, right]
+    side, candidate = _find_candidate(sides)
+    if candidate is None:
+        # Only terms remain, and none are shared.
+        return False
+
+    sides[side] = sides[side] - {candidate}
+    branches = []
+    for additions in _rule(side, candidate):
+        added = (set(), set())
+        for new_side, formula_id in additions:
+            added[new_side].add(formula_id)
+        branches.append((sides[LEFT] | added[LEFT],
+            sides[RIGHT] | added[RIGHT]))
+    return branches
+
+
+def _cached(sequent):
+    """ Return whether the interned sequent is valid, if remembered, or None,
+        marking it as recently used.
+    """
+
+    valid = _cache.pop(sequent, None)
+    if valid is None:
+        if _stats is not None:
+            _stats.cache_misses += 1
+        return None
+    if _stats is not None:
+        _stats.cache_hits += 1
+    _cache[sequent] = valid
+    return valid
+
+
+def _remember(sequent, valid):
+    """ Remember whether the interned sequent is valid, forgetting the least
+        recently used sequent if the cache is full.
+    """
+
+    _cache[sequent] = valid
+    if len(_cache) > CACHE_SIZE:
+        del _cache[next(iter(_cache))]
+
+
+def _valid(sequent):
+    """ Return whether the interned sequent left ⊢ right is valid """
+
+    valid = _cached(sequent)
+    if valid is not None:
+        return valid
+    branches = _branches(sequent)
+    if not isinstance(branches, list):
+        _remember(sequent, branches)
+        return branches
+
+    # Each frame is a sequent being proved and an iterator over its
+    # remaining branches; valid is the result of the last finished sequent,
+    # or None after a new frame is pushed.
+    stack = [(sequent, iter(branches))]
+    valid = None
+    while stack:
+        current, remaining = stack[-1]
+        branch = next(remaining, None) if valid is not False else None
+        if branch is None:
+            # Either a branch failed, or all of them were proved.
+            stack.pop()
+            valid = valid is not False
+            _remember(current, valid)
+            continue
+        valid = _cached(branch)
+        if valid is None:
+            branches = _branches(branch)
+            if isinstance(branches, list):
+                stack.append((branch, iter(branches)))
+                continue
+            valid = branches
+            _remember(branch, valid)
+    return valid
+
+
+@_timed('solve')
 def solve(theorem):
     """ Generate a proof for the given theorem, if possible.
         An invalid theorem will result in a proof containing a contradiction,
@@ -166,61 +672,1456 @@ def solve(theorem):
         # TODO: Add more tests...
     """
 
-    # Find the candidate.
-    candidate = None
-    for side, contents in enumerate(theorem):
-        for formula in contents:
-            if formula[0] in (NOT, AND, OR, IMPLY):
-                candidate = (side, formula)
+    search = SequentSearch(theorem)
+    sides = search.sides
 
-    if candidate is None:
-        # Contract - only terms remain.
-        intersect = theorem[LEFT].intersection(theorem[RIGHT])
-        return [(intersect, intersect)]
+    # Assemble the nested proof bottom up; each open node is the list of
+    # its sequent and its finished subproofs, with the number of subproofs
+    # still to come.
+    open_nodes = []
+    for depth, side, formula_id, branches in search.steps():
+        if side is not None:
+            open_nodes.append([[_export(sides[LEFT], sides[RIGHT])],
+                branches])
+            continue
+
+        intersect = _export_set(sides[LEFT] & sides[RIGHT])
+        proof = [(intersect, intersect)]
+        while open_nodes:
+            node = open_nodes[-1]
+            node[0].append(proof)
+            node[1] -= 1
+            if node[1] > 0:
+                break
+            open_nodes.pop()
+            proof = tuple(node[0])
+        else:
+            return proof
 
-    # Make a copy of the theorem with the candidate removed.
-    new = (theorem[0].copy(), theorem[1].copy())
-    new[candidate[0]].remove(candidate[1])
 
-    # Add the value back in.
-    side, formula = candidate
-    if formula[0] == NOT:
-        new[(side + 1) % 2].add(formula[1])
-        return (theorem, solve(new))
-    elif formula[0] == AND:
-        if side == LEFT:
-            new[LEFT].add(formula[1])
-            new[LEFT].add(formula[2])
-            return (theorem, solve(new))
+@_timed('solve')
+def decide(theorem, proof=False, backend='sequent'):
+    """ Decide whether the given theorem is valid, returning (valid, model).
+
+        The backend is 'sequent' for the proof search below, 'sat' for
+        decide_sat, or 'auto' to use decide_sat for theorems with more than
+        SAT_THRESHOLD distinct connectives.
+
+        A sequent is closed as soon as any formula appears on both sides,
+        without breaking it down further, and the search stops at the first
+        branch which cannot be closed. The model is then a countermodel,
+        mapping each term in that branch to the value which makes the
+        theorem false; it is None if the theorem is valid.
+        If proof is true the full proof from solve is also built, and
+        (valid, model, proof) is returned.
+
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> decide(({(IMPLY, a, b), a}, {b}))
+        (True, None)
+        >>> decide(({(OR, a, b)}, {a}))
+        (False, {'b': True, 'a': False})
+        >>> decide(({(OR, a, b)}, {(OR, a, b)}))
+        (True, None)
+        >>> decide(({a}, {a}), proof=True)
+        (True, None, [({('', 'a')}, {('', 'a')})])
+        >>> decide(({(OR, a, b)}, {a}), backend='sat')
+        (False, {'a': False, 'b': True})
+    """
+
+    if backend == 'auto':
+        left, right = intern_theorem(theorem)
+        connectives = sum(1 for formula_id in _reachable(left | right) \
+                if _ops[formula_id] != TERM)
+        backend = 'sat' if connectives > SAT_THRESHOLD else 'sequent'
+    if backend == 'sat':
+        result = decide_sat(theorem)
+    elif backend == 'sequent':
+        result = _decide_sequent(theorem)
+    else:
+        raise ValueError("Unknown backend {}".format(backend))
+
+    if proof:
+        return result + (solve(theorem),)
+    return result
+
+
+def _decide_sequent(theorem):
+    """ Decide the theorem by proof search, as described in decide.
+
+        Theorems already known to be valid are answered from the cache used
+        by is_valid; invalid ones are searched again for a countermodel.
+    """
+
+    sequent = intern_theorem(theorem)
+    if _cached(sequent):
+        return True, None
+    search = SequentSearch(theorem)
+    valid, model = True, None
+    for depth, side, formula_id, branches in search.steps(close_early=True):
+        if side is None and not search.shared:
+            left, right = search.sides
+            model = {_args[formula_id]: True for formula_id in left}
+            model.update((_args[formula_id], False) for formula_id in right)
+            valid = False
+            break
+    _remember(sequent, valid)
+    return valid, model
+
+
+def iter_proof(theorem):
+    """ Lazily generate the proof of the given theorem, as (depth, sequent)
+        pairs in the top-down order of solve.
+
+        Only the current branch of the search is kept, so this works for
+        formulas far too large to build the whole proof for. Each side of a
+        sequent is a tuple rather than a set of formulas, as hashing large
+        formulas takes time proportional to their size.
+
+        >>> a = (TERM, 'a')
+        >>> for depth, sequent in iter_proof(({(OR, a, (AND, a, a))}, {a})):
+        ...     print(depth, render_theorem(sequent))
+        0 (a ∨ (a ∧ a)) ⊢ a
+        1 a ⊢ a
+        1 (a ∧ a) ⊢ a
+        2 a ⊢ a
+        >>> deep = a
+        >>> for i in range(100000):
+        ...     deep = (NOT, deep)
+        >>> sum(1 for _ in iter_proof(({deep}, {a})))
+        100001
+    """
+
+    search = SequentSearch(theorem)
+    sides = search.sides
+    for depth, side, formula_id, branches in search.steps():
+        if side is None:
+            intersect = _export_tuple(sides[LEFT] & sides[RIGHT])
+            yield depth, (intersect, intersect)
+        else:
+            yield depth, (_export_tuple(sides[LEFT]),
+                    _export_tuple(sides[RIGHT]))
+
+
+def _export_set(formula_ids):
+    """ Return the set of formulas for the given formula IDs """
+
+    return {_formulas[formula_id] for formula_id in formula_ids}
+
+
+def _export_tuple(formula_ids):
+    """ Return a tuple of the formulas for the given formula IDs """
+
+    return tuple(_formulas[formula_id] for formula_id in formula_ids)
+
+
+def _export(left, right):
+    """ Return a theorem for the given sets of formula IDs """
+
+    return (_export_set(left), _export_set(right))
+
+
+def _rule(side, formula_id):
+    """ Return the branches produced by breaking down the interned formula
+        on the given side; each is a list of (side, formula ID) to add.
+    """
+
+    op, args = _ops[formula_id], _args[formula_id]
+    if op == NOT:
+        return [[(1 - side, args[0])]]
+    elif op == AND and side == LEFT or op == OR and side == RIGHT:
+        return [[(side, args[0]), (side, args[1])]]
+    elif op == IMPLY and side == RIGHT:
+        return [[(LEFT, args[0]), (RIGHT, args[1])]]
+    elif op == IMPLY:
+        return [[(RIGHT, args[0])], [(LEFT, args[1])]]
+    return [[(side, args[0])], [(side, args[1])]]
+
+
+# Kinds of entry on the SequentSearch work stack.
+_NODE   = 0
+_BRANCH = 1
+_UNDO   = 2
+
+
+class SequentSearch:
+    """ Explicit-stack LK proof search over a single interned sequent.
+
+        Rather than copying the sequent for every rule, the rules add and
+        remove formulas in place, recording each change on a trail so that
+        it can be undone when the search backtracks to try another branch.
+        The formulas with operators still to be broken down are kept on a
+        stack, so finding the next rule to apply is constant time, and the
+        number of formulas on both sides is kept in self.shared.
+    """
+
+    def __init__(self, theorem):
+        left, right = intern_theorem(theorem)
+        self.sides = (set(left), set(right))
+        self.todo = [(side, formula_id) \
+                for side, contents in enumerate(self.sides) \
+                for formula_id in contents if _ops[formula_id] != TERM]
+        self.trail = []
+        self.shared = len(left & right)
+
+    def _add(self, side, formula_id):
+        """ Add the formula to the given side of the sequent """
+
+        if formula_id in self.sides[side]:
+            return
+        self.sides[side].add(formula_id)
+        self.trail.append((side, formula_id, True))
+        if formula_id in self.sides[1 - side]:
+            self.shared += 1
+        if _ops[formula_id] != TERM:
+            self.todo.append((side, formula_id))
+
+    def _remove(self, side, formula_id):
+        """ Remove the formula, which must be the top of self.todo """
+
+        self.todo.pop()
+        self.sides[side].remove(formula_id)
+        self.trail.append((side, formula_id, False))
+        if formula_id in self.sides[1 - side]:
+            self.shared -= 1
+
+    def _undo(self, mark):
+        """ Undo changes to the sequent until the trail has mark entries """
+
+        trail = self.trail
+        while len(trail) > mark:
+            side, formula_id, added = trail.pop()
+            if formula_id in self.sides[1 - side]:
+                self.shared += -1 if added else 1
+            if added:
+                self.sides[side].remove(formula_id)
+                if _ops[formula_id] != TERM:
+                    self.todo.pop()
+            else:
+                self.sides[side].add(formula_id)
+                self.todo.append((side, formula_id))
+
+    def steps(self, close_early=False):
+        """ Run the search, yielding (depth, side, formula ID, branches) as
+            each rule is about to be applied, and (depth, None, None, 0) for
+            each leaf, where only terms remain.
+            If close_early is true, any sequent with a formula on both sides
+            is also treated as a leaf.
+
+            During each yield self.sides holds the current sequent; callers
+            must copy it if they need it later.
+        """
+
+        stats = _stats
+        live = 1 # Sequents queued or being proved.
+        stack = [(_NODE, 0, None)]
+        while stack:
+            kind, depth, arg = stack.pop()
+            if kind == _UNDO:
+                self._undo(arg)
+                continue
+            elif kind == _BRANCH:
+                for side, formula_id in arg:
+                    self._add(side, formula_id)
+
+            if not self.todo or close_early and self.shared:
+                live -= 1
+                yield depth, None, None, 0
+                continue
+
+            side, formula_id = self.todo[-1]
+            branches = _rule(side, formula_id)
+            live += len(branches) - 1
+            if stats is not None:
+                rule = RULE_SYMBOLS[_ops[formula_id]] + 'LR'[side]
+                stats.rules[rule] = stats.rules.get(rule, 0) + 1
+                stats.branches += len(branches)
+                stats.max_depth = max(stats.max_depth, depth)
+                stats.peak_live = max(stats.peak_live, live)
+            yield depth, side, formula_id, len(branches)
+
+            # Remove the formula, then queue the branches with an undo after
+            # each to restore the sequent for whatever follows.
+            stack.append((_UNDO, None, len(self.trail)))
+            self._remove(side, formula_id)
+            for branch in reversed(branches[1:]):
+                stack.append((_BRANCH, depth + 1, branch))
+                stack.append((_UNDO, None, len(self.trail)))
+            stack.append((_BRANCH, depth + 1, branches[0]))
+
+
+class ProofDAG:
+    """ Proof stored as a directed acyclic graph of interned sequents.
+
+        Node i is the sequent self.sequents[i], a pair of frozensets of
+        formula IDs, proved by rule self.rules[i] from the nodes listed in
+        self.children[i]. Each distinct sequent is stored and proved once,
+        however many times it comes up, and children always come before
+        their parents.
+        A sequent is closed by AXIOM as soon as some formula is on both
+        sides; a leaf which cannot be closed is marked OPEN.
+
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> dag = ProofDAG.prove(({(OR, a, (AND, a, a))}, {a}))
+        >>> dag.valid(), len(dag)
+        (True, 3)
+        >>> for line in dag.render(): print(line.replace('\\t', '. '))
+        (a ∨ (a ∧ a)) ⊢ a    [∨L]
+        . #0: a ⊢ a    [ax]
+        . (a ∧ a) ⊢ a    [∧L]
+        . see #0
+        >>> import io
+        >>> buffer = io.StringIO()
+        >>> dag.write_jsonl(buffer)
+        >>> copy = ProofDAG.read_jsonl(io.StringIO(buffer.getvalue()))
+        >>> list(copy.render()) == list(dag.render())
+        True
+        >>> ProofDAG.prove(({(OR, a, b)}, {a})).valid()
+        False
+    """
+
+    def __init__(self):
+        self.sequents = []
+        self.rules = []
+        self.children = []
+        self.root = None
+        self._index = {}
+
+    def __len__(self):
+        return len(self.sequents)
+
+    def add(self, sequent, rule, children=()):
+        """ Add a node proving the sequent, unless there already is one, and
+            return its index.
+        """
+
+        node = self._index.get(sequent)
+        if node is None:
+            node = len(self.sequents)
+            self._index[sequent] = node
+            self.sequents.append(sequent)
+            self.rules.append(rule)
+            self.children.append(tuple(children))
+        return node
+
+    @classmethod
+    def prove(cls, theorem):
+        """ Build the proof DAG for the given theorem """
+
+        dag = cls()
+        stack = [(intern_theorem(theorem), None, None)]
+        while stack:
+            sequent, rule, branches = stack.pop()
+            if sequent in dag._index:
+                continue
+            if branches is not None:
+                # All of the branches have been proved by now.
+                dag.add(sequent, rule, (dag._index[b] for b in branches))
+                continue
+
+            left, right = sequent
+            if not left.isdisjoint(right):
+                dag.add(sequent, AXIOM)
+                continue
+            side, formula_id = _find_candidate(sequent)
+            if formula_id is None:
+                dag.add(sequent, OPEN)
+                continue
+
+            remaining = [left, right]
+            remaining[side] = remaining[side] - {formula_id}
+            branches = []
+            for additions in _rule(side, formula_id):
+                new = [set(), set()]
+                for added_side, added in additions:
+                    new[added_side].add(added)
+                branches.append((remaining[LEFT] | new[LEFT],
+                    remaining[RIGHT] | new[RIGHT]))
+            rule = RULE_SYMBOLS[_ops[formula_id]] + 'LR'[side]
+            stack.append((sequent, rule, branches))
+            stack.extend((branch, None, None) for branch in reversed(branches))
+        dag.root = dag._index[intern_theorem(theorem)]
+        return dag
+
+    def valid(self):
+        """ Return whether the proof has no OPEN leaves """
+
+        return OPEN not in self.rules
+
+    def render(self):
+        """ Generate the lines of the proof top down, as for render_proof,
+            with the rule used at each step.
+
+            A sequent used in more than one place is labelled with its node
+            number the first time, and referred to by that number after.
+            The formulas on each side are listed in sorted order.
+
+            >>> deep = a = (TERM, 'a')
+            >>> for i in range(5000):
+            ...     deep = (NOT, deep)
+            >>> lines = list(ProofDAG.prove(({deep}, {a})).render())
+            >>> len(lines), lines[-1]
+            (5001, 'a ⊢ a    [ax]')
+        """
+
+        uses = [0] * len(self)
+        for children in self.children:
+            for child in children:
+                uses[child] += 1
+        shown = set()
+        stack = [(self.root, 0)]
+        while stack:
+            node, indent = stack.pop()
+            prefix = '\t' * indent
+            if uses[node] > 1:
+                if node in shown:
+                    yield prefix + 'see #{}'.format(node)
+                    continue
+                shown.add(node)
+                prefix += '#{}: '.format(node)
+            # Sort each side, since the order of a frozenset can change
+            # when the proof is read back in.
+            left, right = (', '.join(sorted(render_formula(_formulas[i]) \
+                    for i in side)) for side in self.sequents[node])
+            yield '{}{} {} {}    [{}]'.format(prefix, left, TURNSTYLE, right,
+                    self.rules[node])
+            children = self.children[node]
+            if len(children) > 1:
+                indent += 1
+            stack.extend((child, indent) for child in reversed(children))
+
+    def write_jsonl(self, f):
+        """ Write the proof to the file as JSON lines.
+
+            The formulas come first, each as {"f": n, "term": name} or
+            {"f": n, "op": op, "args": [...]}, numbered from 0 with each
+            after its subformulas. Then come the nodes, children first, as
+            {"n": i, "l": [...], "r": [...], "rule": rule, "c": [...]}, and
+            finally {"root": i}.
+        """
+
+        used = set()
+        for left, right in self.sequents:
+            used |= left
+            used |= right
+        numbers = {}
+        for formula_id in sorted(_reachable(used)):
+            numbers[formula_id] = len(numbers)
+            if _ops[formula_id] == TERM:
+                record = {'f': numbers[formula_id], 'term': _args[formula_id]}
+            else:
+                record = {'f': numbers[formula_id], 'op': _ops[formula_id],
+                        'args': [numbers[arg] for arg in _args[formula_id]]}
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+        for node, (left, right) in enumerate(self.sequents):
+            record = {'n': node,
+                    'l': sorted(numbers[formula_id] for formula_id in left),
+                    'r': sorted(numbers[formula_id] for formula_id in right),
+                    'rule': self.rules[node], 'c': list(self.children[node])}
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        f.write(json.dumps({'root': self.root}) + '\n')
+
+    @classmethod
+    def read_jsonl(cls, lines):
+        """ Read a proof written by write_jsonl from an iterable of lines """
+
+        dag = cls()
+        ids = [] # Maps the formula numbers in the file to interned IDs.
+        for line in lines:
+            record = json.loads(line)
+            if 'f' in record:
+                # Each formula comes after its subformulas, so it can be
+                # interned from their IDs as it is read.
+                if 'term' in record:
+                    ids.append(_intern(TERM, record['term']))
+                else:
+                    ids.append(_intern(record['op'],
+                        tuple(ids[arg] for arg in record['args'])))
+            elif 'n' in record:
+                sequent = tuple(frozenset(ids[number] \
+                        for number in record[side]) for side in ('l', 'r'))
+                dag.add(sequent, record['rule'], record['c'])
+            else:
+                dag.root = record['root']
+        return dag
+
+
+def _reachable(formula_ids):
+    """ Return the set of IDs of the given formulas and their subformulas """
+
+    seen = set()
+    stack = list(formula_ids)
+    while stack:
+        formula_id = stack.pop()
+        if formula_id in seen:
+            continue
+        seen.add(formula_id)
+        if _ops[formula_id] != TERM:
+            stack.extend(_args[formula_id])
+    return seen
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _compile(formula_id):
+    """ Compile the interned formula into (terms, program).
+
+        terms is the sorted tuple of term names, which are loaded into the
+        first registers, and program is a tuple of (op, register, register)
+        instructions, each storing its result in the next register. The
+        last register holds the value of the formula.
+    """
+
+    ids = sorted(_reachable((formula_id,)))
+    terms = tuple(sorted(_args[f] for f in ids if _ops[f] == TERM))
+    registers = {}
+    for f in ids:
+        if _ops[f] == TERM:
+            registers[f] = terms.index(_args[f])
+    program = []
+    for f in ids:
+        if _ops[f] != TERM:
+            args = [registers[arg] for arg in _args[f]]
+            program.append((_ops[f], args[0], args[-1]))
+            registers[f] = len(terms) + len(program) - 1
+    if not program:
+        # Copy the term, so the result is always in the last register.
+        program.append((AND, registers[formula_id], registers[formula_id]))
+    return terms, tuple(program)
+
+
+def compile_formula(formula):
+    """ Compile the formula to a flat program for truth_table; see _compile.
+
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> compile_formula((IMPLY, (NOT, a), b))
+        (('a', 'b'), (('!', 0, 0), ('>', 2, 1)))
+    """
+
+    return _compile(intern_formula(formula))
+
+
+def _term_masks(terms):
+    """ Return the bitmasks of the given terms, and of all assignments.
+
+        Bit k of each mask is the value of the term in assignment k, where
+        term i is true whenever bit i of k is set.
+    """
+
+    size = 1 << len(terms)
+    full = (1 << size) - 1
+    masks = {}
+    for i, name in enumerate(terms):
+        # Start with a block of 2**i ones above 2**i zeros, then double it
+        # until it covers every assignment.
+        width = 1 << (i + 1)
+        mask = ((1 << (1 << i)) - 1) << (1 << i)
+        while width < size:
+            mask |= mask << width
+            width *= 2
+        masks[name] = mask
+    return masks, full
+
+
+def _run(program, terms, masks, full):
+    """ Run the compiled program over the given term masks """
+
+    registers = [masks[name] for name in terms]
+    for op, a, b in program:
+        if op == NOT:
+            registers.append(full ^ registers[a])
+        elif op == AND:
+            registers.append(registers[a] & registers[b])
+        elif op == OR:
+            registers.append(registers[a] | registers[b])
         else:
-            new_2 = (new[0].copy(), new[1].copy())
-            new[RIGHT].add(formula[1])
-            new_2[RIGHT].add(formula[2])
-            return (theorem, solve(new), solve(new_2))
-    elif formula[0] == OR:
-        if side == RIGHT:
-            new[RIGHT].add(formula[1])
-            new[RIGHT].add(formula[2])
-            return (theorem, solve(new))
+            registers.append((full ^ registers[a]) | registers[b])
+    return registers[-1]
+
+
+def truth_table(formula, terms=None):
+    """ Evaluate the formula under every assignment at once.
+
+        Returns (terms, table), where terms is a sorted tuple of term names
+        and bit k of the integer table is the value of the formula when term
+        i is true exactly if bit i of k is set. Each operator is a single
+        bitwise operation over all 2**n assignments. terms may be given to
+        evaluate over a larger set of terms; there may be at most
+        MAX_TABLE_TERMS of them.
+
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> terms, table = truth_table((AND, a, b))
+        >>> terms, bin(table)
+        (('a', 'b'), '0b1000')
+        >>> bin(truth_table((OR, a, b))[1])
+        '0b1110'
+        >>> bin(truth_table(a, terms=('a', 'b'))[1])
+        '0b1010'
+    """
+
+    own_terms, program = compile_formula(formula)
+    if terms is None:
+        terms = own_terms
+    else:
+        terms = tuple(sorted(terms))
+    if len(terms) > MAX_TABLE_TERMS:
+        raise ValueError("Too many terms for a truth table: {}"\
+                .format(len(terms)))
+    masks, full = _term_masks(terms)
+    return terms, _run(program, own_terms, masks, full)
+
+
+def is_tautology(formula):
+    """ Return whether the formula is true under every assignment.
+
+        >>> a = (TERM, 'a')
+        >>> is_tautology((OR, a, (NOT, a))), is_tautology(a)
+        (True, False)
+    """
+
+    terms, table = truth_table(formula)
+    return table == (1 << (1 << len(terms))) - 1
+
+
+def is_satisfiable(formula):
+    """ Return whether the formula is true under some assignment.
+
+        >>> a = (TERM, 'a')
+        >>> is_satisfiable((AND, a, (NOT, a))), is_satisfiable(a)
+        (False, True)
+    """
+
+    return truth_table(formula)[1] != 0
+
+
+def equivalent(first, second):
+    """ Return whether the two formulas agree under every assignment.
+
+        Truth tables are compared when there are at most MAX_TABLE_TERMS
+        terms between them; otherwise their BDDs are.
+
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> equivalent((IMPLY, a, b), (OR, (NOT, a), b))
+        True
+        >>> equivalent((AND, a, b), a)
+        False
+        >>> equivalent((OR, a, (NOT, a)), (OR, b, (NOT, b)))
+        True
+    """
+
+    terms = set(compile_formula(first)[0]) | set(compile_formula(second)[0])
+    if len(terms) > MAX_TABLE_TERMS:
+        return BDD_MANAGER.equivalent(first, second)
+    return truth_table(first, terms)[1] == truth_table(second, terms)[1]
+
+
+def tseitin(theorem):
+    """ Encode the negation of the given theorem as CNF.
+
+        Returns (clauses, terms), where each clause is a list of non-zero
+        integer literals (-v for the negation of variable v), and terms maps
+        each term name to its variable. The clauses are satisfiable exactly
+        when some assignment makes every assumption true and every result
+        false, ie when the theorem is invalid.
+        Each connective gets a variable constrained to equal its value; ¬
+        needs no variable, and just negates the literal of its subformula.
+
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> clauses, terms = tseitin(({(AND, a, b)}, set()))
+        >>> sorted(terms)
+        ['a', 'b']
+        >>> len(clauses)
+        4
+    """
+
+    left, right = intern_theorem(theorem)
+    literals = {}
+    terms = {}
+    clauses = []
+    variables = 0
+    # Subformulas are interned before the formulas containing them, so
+    # visiting IDs in order sees each subformula's literal first.
+    for formula_id in sorted(_reachable(left | right)):
+        op, args = _ops[formula_id], _args[formula_id]
+        if op == NOT:
+            literals[formula_id] = -literals[args[0]]
+            continue
+        variables += 1
+        var = variables
+        literals[formula_id] = var
+        if op == TERM:
+            terms[args] = var
+            continue
+        x, y = literals[args[0]], literals[args[1]]
+        if op == AND:
+            clauses.extend(([-var, x], [-var, y], [var, -x, -y]))
+        elif op == OR:
+            clauses.extend(([var, -x], [var, -y], [-var, x, y]))
         else:
-            new_2 = (new[0].copy(), new[1].copy())
-            new[LEFT].add(formula[1])
-            new_2[LEFT].add(formula[2])
-            return (theorem, solve(new), solve(new_2))
-    elif formula[0] == IMPLY:
-        if side == RIGHT:
-            new[LEFT].add(formula[1])
-            new[RIGHT].add(formula[2])
-            return (theorem, solve(new))
+            clauses.extend(([var, x], [var, -y], [-var, -x, y]))
+
+    clauses.extend([literals[formula_id]] for formula_id in left)
+    clauses.extend([-literals[formula_id]] for formula_id in right)
+    return clauses, terms
+
+
+def decide_sat(theorem):
+    """ Decide whether the given theorem is valid using the SAT solver on
+        its Tseitin encoding, returning (valid, model) as for decide.
+
+        >>> a, b, c = (TERM, 'a'), (TERM, 'b'), (TERM, 'c')
+        >>> decide_sat(({(IMPLY, a, b), (IMPLY, b, c)}, {(IMPLY, a, c)}))
+        (True, None)
+        >>> decide_sat((set(), {(IMPLY, a, b)}))
+        (False, {'a': True, 'b': False})
+    """
+
+    clauses, terms = tseitin(theorem)
+    solver = SATSolver()
+    for clause in clauses:
+        solver.add_clause(clause)
+    if not solver.solve():
+        return True, None
+    return False, {name: solver.value(var) > 0 \
+            for name, var in sorted(terms.items())}
+
+
+def luby(i):
+    """ Return the i'th term (from 1) of the Luby restart sequence.
+
+        >>> [luby(i) for i in range(1, 16)]
+        [1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8]
+    """
+
+    # Find the finite subsequence containing the i'th term, then its
+    # position within that.
+    i -= 1
+    size = 1
+    power = 0
+    while size < i + 1:
+        power += 1
+        size = 2 * size + 1
+    while size - 1 != i:
+        size = (size - 1) // 2
+        power -= 1
+        i %= size
+    return 2 ** power
+
+
+class SATSolver:
+    """ Conflict-driven clause learning SAT solver.
+
+        Variables are positive integers and literals are non-zero integers,
+        with -v the negation of v. Each clause watches its first two
+        literals, and is only looked at when one of them becomes false.
+        Conflicts are analysed back to the first unique implication point
+        to learn a new clause, decisions pick the unassigned variable with
+        the highest VSIDS activity (keeping the phase it last had), and the
+        search restarts following the Luby sequence.
+
+        >>> solver = SATSolver()
+        >>> for clause in ([1, 2], [-1, 2], [1, -2]):
+        ...     solver.add_clause(clause)
+        >>> solver.solve(), solver.value(1), solver.value(2)
+        (True, 1, 1)
+        >>> solver.add_clause([-1, -2])
+        >>> solver.solve()
+        False
+    """
+
+    def __init__(self):
+        self.ok = True
+        self.clauses = []
+        self.watches = {} # Maps each literal to the clauses watching it.
+        self.assign = [0] # Value of each variable: 1, -1, or 0 if unset.
+        self.level = [0]
+        self.reason = [None]
+        self.activity = [0.0]
+        self.phase = [-1]
+        self.trail = []
+        self.trail_lim = [] # Start of each decision level in the trail.
+        self.head = 0 # Next trail entry to propagate.
+        self.order = [] # Heap of (-activity, variable), possibly stale.
+        self.increment = 1.0
+        self.conflicts = 0
+
+    def _new_vars(self, var):
+        """ Make sure the variables up to var exist """
+
+        while len(self.assign) <= var:
+            new = len(self.assign)
+            self.assign.append(0)
+            self.level.append(0)
+            self.reason.append(None)
+            self.activity.append(0.0)
+            self.phase.append(-1)
+            self.watches[new] = []
+            self.watches[-new] = []
+            heapq.heappush(self.order, (0.0, new))
+
+    def value(self, literal):
+        """ Return 1 if literal is true, -1 if false, or 0 if unassigned """
+
+        value = self.assign[abs(literal)]
+        return value if literal > 0 else -value
+
+    def add_clause(self, literals):
+        """ Add a clause, given as an iterable of literals """
+
+        self._new_vars(max((abs(l) for l in literals), default=0))
+        if self.trail_lim:
+            self._backtrack(0)
+        clause = []
+        for literal in literals:
+            if -literal in clause:
+                return # Always true.
+            if literal not in clause and self.value(literal) >= 0:
+                if self.value(literal) > 0:
+                    return # Already satisfied at the top level.
+                clause.append(literal)
+
+        if not clause:
+            self.ok = False
+        elif len(clause) == 1:
+            self._enqueue(clause[0], None)
+            self.ok = self.ok and self._propagate() is None
         else:
-            new_2 = (new[0].copy(), new[1].copy())
-            new[RIGHT].add(formula[1])
-            new_2[LEFT].add(formula[2])
-            return (theorem, solve(new), solve(new_2))
-    
-    return theorem
+            self._attach(clause)
+
+    def _attach(self, clause):
+        """ Add a clause of at least two literals, watching the first two """
+
+        self.clauses.append(clause)
+        self.watches[clause[0]].append(clause)
+        self.watches[clause[1]].append(clause)
+
+    def _enqueue(self, literal, reason):
+        """ Make literal true, as implied by the reason clause (or decided) """
+
+        var = abs(literal)
+        self.assign[var] = 1 if literal > 0 else -1
+        self.level[var] = len(self.trail_lim)
+        self.reason[var] = reason
+        self.trail.append(literal)
+
+    def _propagate(self):
+        """ Propagate the assignments on the trail, returning a conflicting
+            clause or None.
+        """
+
+        while self.head < len(self.trail):
+            false = -self.trail[self.head]
+            self.head += 1
+            watching = self.watches[false]
+            kept = []
+            i = 0
+            while i < len(watching):
+                clause = watching[i]
+                i += 1
+                # Keep the false literal second.
+                if clause[0] == false:
+                    clause[0], clause[1] = clause[1], false
+                if self.value(clause[0]) > 0:
+                    kept.append(clause)
+                    continue
+
+                # Look for another literal to watch.
+                for k in range(2, len(clause)):
+                    if self.value(clause[k]) >= 0:
+                        clause[1], clause[k] = clause[k], false
+                        self.watches[clause[1]].append(clause)
+                        break
+                else:
+                    kept.append(clause)
+                    if self.value(clause[0]) < 0:
+                        kept.extend(watching[i:])
+                        self.watches[false] = kept
+                        return clause
+                    self._enqueue(clause[0], clause)
+            self.watches[false] = kept
+        return None
+
+    def _bump(self, var):
+        """ Increase the activity of the variable """
+
+        self.activity[var] += self.increment
+        if self.activity[var] > 1e100:
+            # Rescale everything to avoid overflow.
+            self.activity = [a * 1e-100 for a in self.activity]
+            self.increment *= 1e-100
+            self.order = [(-self.activity[v], v) \
+                    for v in range(1, len(self.assign))]
+            heapq.heapify(self.order)
+        heapq.heappush(self.order, (-self.activity[var], var))
+
+    def _analyse(self, conflict):
+        """ Return the clause learnt from the conflict, asserting literal
+            first, and the level to backtrack to.
+        """
+
+        seen = set()
+        learnt = [None]
+        level = len(self.trail_lim)
+        pending = 0
+        index = len(self.trail) - 1
+        clause = conflict
+        literal = None
+        while True:
+            for other in (clause if literal is None else clause[1:]):
+                var = abs(other)
+                if var not in seen and self.level[var] > 0:
+                    seen.add(var)
+                    self._bump(var)
+                    if self.level[var] == level:
+                        pending += 1
+                    else:
+                        learnt.append(other)
+            # Step back to the most recent literal involved in the conflict.
+            while abs(self.trail[index]) not in seen:
+                index -= 1
+            literal = self.trail[index]
+            index -= 1
+            pending -= 1
+            if pending == 0:
+                break
+            clause = self.reason[abs(literal)]
+        learnt[0] = -literal
+
+        if len(learnt) == 1:
+            return learnt, 0
+        # Watch the literal from the highest remaining level second, so the
+        # clause is unit again once we backtrack to that level.
+        best = max(range(1, len(learnt)),
+                key=lambda i: self.level[abs(learnt[i])])
+        learnt[1], learnt[best] = learnt[best], learnt[1]
+        return learnt, self.level[abs(learnt[1])]
+
+    def _backtrack(self, level):
+        """ Undo all assignments above the given decision level """
+
+        if len(self.trail_lim) <= level:
+            return
+        start = self.trail_lim[level]
+        for literal in self.trail[start:]:
+            var = abs(literal)
+            self.phase[var] = self.assign[var]
+            self.assign[var] = 0
+            self.reason[var] = None
+            heapq.heappush(self.order, (-self.activity[var], var))
+        del self.trail[start:]
+        del self.trail_lim[level:]
+        self.head = start
+
+    def _pick(self):
+        """ Return the unassigned variable with the highest activity, or 0 """
+
+        while self.order:
+            _, var = heapq.heappop(self.order)
+            if self.assign[var] == 0:
+                return var
+        return 0
+
+    def solve(self):
+        """ Return whether the clauses are satisfiable.
+
+            If they are, value() gives a satisfying assignment.
+        """
+
+        if not self.ok:
+            return False
+        restarts = 0
+        budget = RESTART_BASE
+        while True:
+            conflict = self._propagate()
+            if conflict is not None:
+                self.conflicts += 1
+                if not self.trail_lim:
+                    self.ok = False
+                    return False
+                learnt, level = self._analyse(conflict)
+                self._backtrack(level)
+                if len(learnt) == 1:
+                    self._enqueue(learnt[0], None)
+                else:
+                    self._attach(learnt)
+                    self._enqueue(learnt[0], learnt)
+                self.increment /= 0.95
+                budget -= 1
+                continue
+
+            if budget <= 0:
+                restarts += 1
+                budget = RESTART_BASE * luby(restarts + 1)
+                self._backtrack(0)
+                continue
+
+            var = self._pick()
+            if var == 0:
+                return True
+            self.trail_lim.append(len(self.trail))
+            self._enqueue(var * self.phase[var], None)
+
+
+def _terms_in_order(formula_id):
+    """ Return the term names in the interned formula, in the order they
+        are first reached by a left to right depth first walk.
+    """
+
+    names = []
+    seen = set()
+    stack = [formula_id]
+    while stack:
+        current = stack.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        if _ops[current] == TERM:
+            names.append(_args[current])
+        else:
+            stack.extend(reversed(_args[current]))
+    return names
+
+
+class BDD:
+    """ Manager for reduced ordered binary decision diagrams.
+
+        Nodes are integers: 0 and 1 are the constants, and every other node
+        tests a variable, with a low (false) and high (true) child. A unique
+        table makes sure each (variable, low, high) is only ever built once,
+        so equal functions are always the same node, and ITE results are
+        kept in a computed table.
+        Variables are ordered by when they were first seen; the terms of
+        each new formula are added in depth first order, which tends to
+        keep related terms close together.
+        Formulas are converted through their interned IDs, and the BDD of
+        each interned subformula is remembered, so formulas sharing parts
+        with ones seen before reuse their nodes.
+
+        >>> bdd = BDD()
+        >>> a, b = (TERM, 'a'), (TERM, 'b')
+        >>> bdd.to_bdd((IMPLY, a, b)) == bdd.to_bdd((OR, (NOT, a), b))
+        True
+        >>> bdd.to_bdd((AND, a, (NOT, a)))
+        0
+        >>> bdd.count_models((OR, a, b)), bdd.count_models(a, ['a', 'b'])
+        (3, 2)
+        >>> bdd.any_model((AND, a, (NOT, b)))
+        {'a': True, 'b': False}
+        >>> bdd.any_model((AND, a, (NOT, a))) is None
+        True
+        >>> chain = a
+        >>> for i in range(2000):
+        ...     chain = (AND, chain, (TERM, 'v{}'.format(i)))
+        >>> bdd.count_models(chain), bdd.equivalent(chain, (AND, chain, a))
+        (1, True)
+    """
+
+    def __init__(self):
+        self._levels = {} # Maps variable name to level.
+        self._names = [] # Maps level to variable name.
+        self._var = [None, None] # Level of each node; None for constants.
+        self._low = [0, 1]
+        self._high = [0, 1]
+        self._unique = {}
+        self._computed = {}
+        self._formulas = {} # Maps interned formula IDs to nodes.
+
+    def __len__(self):
+        """ Return the number of nodes, including the constants """
+
+        return len(self._var)
+
+    def _level(self, node):
+        """ Return the level of the node, with constants below all others """
+
+        level = self._var[node]
+        return len(self._names) if level is None else level
+
+    def _make(self, level, low, high):
+        """ Return the node testing the variable at level """
+
+        if low == high:
+            return low
+        key = (level, low, high)
+        node = self._unique.get(key)
+        if node is None:
+            node = len(self._var)
+            self._var.append(level)
+            self._low.append(low)
+            self._high.append(high)
+            self._unique[key] = node
+        return node
+
+    def var(self, name):
+        """ Return the node for the variable with the given name """
+
+        level = self._levels.get(name)
+        if level is None:
+            level = len(self._names)
+            self._levels[name] = level
+            self._names.append(name)
+        return self._make(level, 0, 1)
+
+    def ite(self, f, g, h):
+        """ Return the node for "if f then g else h" """
+
+        # Each stack entry is an (f, g, h) still to evaluate, with None, or
+        # one waiting on its cofactors, with its level; that entry is only
+        # popped once the results for its low and high cofactors are on top
+        # of results.
+        stack = [((f, g, h), None)]
+        results = []
+        while stack:
+            key, level = stack.pop()
+            if level is not None:
+                high = results.pop()
+                low = results.pop()
+                result = self._make(level, low, high)
+                self._computed[key] = result
+                results.append(result)
+                continue
+
+            f, g, h = key
+            if f == 1 or g == h:
+                results.append(g)
+                continue
+            if f == 0:
+                results.append(h)
+                continue
+            if g == 1 and h == 0:
+                results.append(f)
+                continue
+            result = self._computed.get(key)
+            if result is not None:
+                results.append(result)
+                continue
+
+            level = min(self._level(f), self._level(g), self._level(h))
+            lows = []
+            highs = []
+            for node in key:
+                if self._var[node] == level:
+                    lows.append(self._low[node])
+                    highs.append(self._high[node])
+                else:
+                    lows.append(node)
+                    highs.append(node)
+            stack.append((key, level))
+            stack.append((tuple(highs), None))
+            stack.append((tuple(lows), None))
+        return results[0]
+
+    def to_bdd(self, formula):
+        """ Return the node for the given formula """
+
+        root = intern_formula(formula)
+        if root in self._formulas:
+            return self._formulas[root]
+        for name in _terms_in_order(root):
+            self.var(name)
+
+        # Subformulas have lower IDs than the formulas containing them.
+        for formula_id in sorted(_reachable((root,))):
+            if formula_id in self._formulas:
+                continue
+            op, args = _ops[formula_id], _args[formula_id]
+            if op == TERM:
+                node = self.var(args)
+            elif op == NOT:
+                node = self.ite(self._formulas[args[0]], 0, 1)
+            else:
+                first, second = (self._formulas[arg] for arg in args)
+                if op == AND:
+                    node = self.ite(first, second, 0)
+                elif op == OR:
+                    node = self.ite(first, 1, second)
+                else:
+                    node = self.ite(first, second, 1)
+            self._formulas[formula_id] = node
+        return self._formulas[root]
+
+    def equivalent(self, first, second):
+        """ Return whether the two formulas agree under every assignment """
+
+        return self.to_bdd(first) == self.to_bdd(second)
+
+    def count_models(self, formula, terms=None):
+        """ Return the number of assignments to the terms of the formula
+            (or to the given terms, which must include them) making it true.
+        """
+
+        root = self.to_bdd(formula)
+        if terms is None:
+            terms = set(compile_formula(formula)[0])
+
+        # Count the models over every variable, bottom up, then scale down
+        # to just the terms requested.
+        total = len(self._names)
+        counts = {0: 0, 1: 1}
+        stack = [root]
+        while stack:
+            node = stack[-1]
+            if node in counts:
+                stack.pop()
+                continue
+            low, high = self._low[node], self._high[node]
+            missing = [child for child in (low, high) if child not in counts]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            level = self._level(node)
+            # Variables skipped between a node and its child are free.
+            counts[node] = \
+                    (counts[low] << (self._level(low) - level - 1)) + \
+                    (counts[high] << (self._level(high) - level - 1))
+        models = counts[root] << self._level(root)
+        if len(terms) <= total:
+            return models >> (total - len(terms))
+        return models << (len(terms) - total)
+
+    def any_model(self, formula):
+        """ Return an assignment to the terms of the formula making it true,
+            as a dict, or None if it is unsatisfiable.
+        """
+
+        node = self.to_bdd(formula)
+        if node == 0:
+            return None
+        model = {name: False for name in compile_formula(formula)[0]}
+        while node != 1:
+            name = self._names[self._var[node]]
+            if self._high[node] != 0:
+                model[name] = True
+                node = self._high[node]
+            else:
+                model[name] = False
+                node = self._low[node]
+        return model
+
+
+# Manager shared by the module level BDD functions.
+BDD_MANAGER = BDD()
+
+
+def to_bdd(formula):
+    """ Return the node for the formula in the shared BDD_MANAGER """
+
+    return BDD_MANAGER.to_bdd(formula)
+
+
+def count_models(formula, terms=None):
+    """ Return the number of models of the formula; see BDD.count_models.
+
+        >>> a, b, c = (TERM, 'a'), (TERM, 'b'), (TERM, 'c')
+        >>> count_models((OR, a, (AND, b, c)))
+        5
+    """
+
+    return BDD_MANAGER.count_models(formula, terms)
+
+
+def any_model(formula):
+    """ Return some model of the formula; see BDD.any_model.
+
+        >>> any_model((IMPLY, (TERM, 'a'), (TERM, 'b')))
+        {'a': True, 'b': True}
+    """
+
+    return BDD_MANAGER.any_model(formula)
+
+
+class _Timeout(Exception):
+    """ Raised in a prove_batch worker when a theorem takes too long """
+
+
+def _alarm(signum, frame):
+    raise _Timeout()
+
+
+def _prove_chunk(chunk, timeout, backend, stats=False):
+    """ Decide each (index, theorem) pair in the chunk, returning a list of
+        (index, status, model) results for prove_batch, with the record of
+        the ProverStats for each theorem appended if stats is true.
+    """
+
+    use_timer = timeout is not None and hasattr(signal, 'setitimer')
+    if use_timer:
+        previous = signal.signal(signal.SIGALRM, _alarm)
+    results = []
+    try:
+        for index, theorem in chunk:
+            with instrument() if stats else nullcontext() as counters:
+                try:
+                    if use_timer:
+                        signal.setitimer(signal.ITIMER_REAL, timeout)
+                    if isinstance(theorem, str):
+                        theorem = parse_theorem(theorem)
+                    valid, model = decide(theorem, backend=backend)
+                    result = (index, VALID if valid else INVALID, model)
+                except _Timeout:
+                    result = (index, TIMEOUT, None)
+                except ValueError as e:
+                    result = (index, ERROR, str(e))
+                except Exception as e:
+                    # Report anything else for this theorem alone, rather
+                    # than failing the whole batch.
+                    result = (index, ERROR,
+                            "{}: {}".format(type(e).__name__, e))
+                finally:
+                    if use_timer:
+                        signal.setitimer(signal.ITIMER_REAL, 0)
+            if stats:
+                result += (counters.record(),)
+            results.append(result)
+    finally:
+        if use_timer:
+            signal.signal(signal.SIGALRM, previous)
+    return results
+
+
+def _chunks(theorems, size):
+    """ Group the theorems into lists of up to size (index, theorem) pairs """
+
+    chunk = []
+    for pair in enumerate(theorems):
+        chunk.append(pair)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def prove_batch(theorems, workers=None, chunksize=16, timeout=None,
+        ordered=True, backend='auto', stats=False):
+    """ Decide many independent theorems over a pool of processes.
+
+        theorems is an iterable of theorems, or of strings accepted by
+        parse_theorem; it is read lazily, a few chunks ahead of the workers.
+        Yields (index, status, model) for each theorem, where status is
+        VALID, INVALID, TIMEOUT if deciding it took over timeout seconds,
+        or ERROR if it could not be parsed or deciding it failed (with the
+        message as the model).
+        Results are yielded in input order if ordered is true, and as soon
+        as each chunk finishes otherwise. workers defaults to the number of
+        CPUs; 0 decides everything in this process.
+        If stats is true, each result also has the ProverStats.record() for
+        deciding that theorem, collected in whichever process decided it.
+
+        >>> theorems = ["a > b, a: b", "a | b: a", "a +: b"]
+        >>> for result in prove_batch(theorems, workers=0): print(result)
+        (0, 'valid', None)
+        (1, 'invalid', {'b': True, 'a': False})
+        (2, 'error', "Unknown token '+' at 2")
+        >>> [status for _, status, _ in prove_batch(theorems, workers=2,
+        ...         chunksize=1)]
+        ['valid', 'invalid', 'error']
+        >>> result = next(prove_batch(["c > d, c: d"], workers=0, stats=True))
+        >>> result[3]['rules'], sorted(result[3]['phases'])
+        ({'→L': 1}, ['parse', 'solve'])
+
+        Valid theorems are remembered, as for is_valid, so repeats are not
+        searched again:
+
+        >>> result = next(prove_batch(["c > d, c: d"], workers=0, stats=True))
+        >>> result[3]['rules'], result[3]['cache_hits']
+        ({}, 1)
+    """
+
+    chunks = _chunks(theorems, chunksize)
+    if workers == 0:
+        for chunk in chunks:
+            yield from _prove_chunk(chunk, timeout, backend, stats)
+        return
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    buffered = {}
+    next_index = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        exhausted = False
+        while pending or not exhausted:
+            # Keep a couple of chunks queued for every worker.
+            while not exhausted and len(pending) < 2 * workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                else:
+                    pending.add(pool.submit(_prove_chunk, chunk, timeout,
+                        backend, stats))
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for result in future.result():
+                    if not ordered:
+                        yield result
+                    else:
+                        buffered[result[0]] = result
+            while next_index in buffered:
+                yield buffered.pop(next_index)
+                next_index += 1
+
+
+def main(argv):
+    """ Decide the theorems in the given file (or stdin), one per line,
+        printing the results by line number.
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Decide whether each " \
+            "theorem, of the form 'assumption, ...: result, ...', is valid")
+    parser.add_argument('file', nargs='?', default='-',
+            help="file of theorems, one per line ('-' for stdin)")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+            help="number of worker processes (default: one per CPU)")
+    parser.add_argument('--chunksize', type=int, default=16,
+            help="theorems sent to a worker at a time")
+    parser.add_argument('--timeout', type=float, default=None,
+            help="seconds allowed for each theorem")
+    parser.add_argument('--backend', default='auto',
+            choices=('auto', 'sequent', 'sat'))
+    parser.add_argument('--unordered', action='store_true',
+            help="print results as they complete")
+    parser.add_argument('--stats', metavar='PATH',
+            help="write the prover statistics for each theorem to PATH " \
+                    "as JSON lines")
+    args = parser.parse_args(argv)
+
+    f = sys.stdin if args.file == '-' else open(args.file)
+    stats = None if args.stats is None else open(args.stats, 'w')
+    name = '<stdin>' if args.file == '-' else args.file
+    with f, stats or nullcontext():
+        # The line number of each theorem, by index, filled in as
+        # prove_batch reads ahead of the results.
+        numbers = []
+        def lines():
+            for number, line in theorem_lines(f):
+                numbers.append(number)
+                yield line
+        results = prove_batch(lines(), workers=args.workers,
+                chunksize=args.chunksize, timeout=args.timeout,
+                ordered=not args.unordered, backend=args.backend,
+                stats=stats is not None)
+        for index, status, model, *record in results:
+            number = numbers[index]
+            if record:
+                record[0]['line'] = number
+                stats.write(json.dumps(record[0], ensure_ascii=False) + '\n')
+            if status == ERROR:
+                model = "{}:{}: {}".format(name, number, model)
+            if model is None:
+                print("{}\t{}".format(number, status))
+            else:
+                print("{}\t{}\t{}".format(number, status, model))
 
 
 if __name__ == "__main__":
-    import doctest
-    doctest.testmod()
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        import doctest
+        doctest.testmod()
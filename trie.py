@@ -1,30 +1,94 @@
 """ Trie implementation, for data structure revision """
 
+import mmap
+import pickle
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
+from collections import deque
+from heapq import heappush, heappop, merge
+from operator import itemgetter
+
+# Number of pairs sorted in memory at once by Trie.from_unsorted, and the
+# number of pairs pickled together when spilling a sorted run to disk.
+SORT_CHUNK_SIZE = 1000000
+SPILL_BLOCK_SIZE = 4096
+
+# Layout of the file written by Trie.save; see MappedTrie for the sections
+# following the header.
+MAPPED_MAGIC = b'TRIE0001'
+MAPPED_HEADER = struct.Struct('<8sQQQ') # magic, nodes, edges, values
+
+
+def _identity(value):
+    """ Default scoring function for Trie.complete """
+    return value
+
+
 class Trie:
-    """ Recursive Trie implementation """
+    """ Trie implementation where each node is itself a Trie.
+
+        The methods walk the nodes with an explicit stack or loop, so the
+        depth of a key is not limited by the recursion limit. Pickling still
+        recurses through the nodes; use save for very deep tries.
+    """
+
+    __slots__ = ('nodes', 'has_value', 'value', 'best', 'size')
 
     def __init__(self):
         self.nodes = {}
         self.has_value = None
         self.value = None
+        self.size = 0 # Number of keys stored in this subtrie.
+        # Cached (score function, best score in this subtrie) used by
+        # complete; reset along the path of every insert and delete.
+        self.best = None
+
+    def _find(self, key):
+        """ Return the node reached by walking the given key, or None.
+
+            This walks the trie iteratively, one character at a time, so long
+            keys neither copy the key nor hit the recursion limit.
+        """
+
+        node = self
+        for char in key:
+            node = node.nodes.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _locate(self, prefix):
+        """ Return the first node whose key starts with prefix, along with the
+            full key of that node, or (None, None) if there is no such node.
+        """
+
+        return self._find(prefix), prefix
+
+    def _edges(self):
+        """ Return (label, subtrie) pairs for the children of this node """
+
+        return self.nodes.items()
 
     def __getitem__(self, key):
         """ Retrieve the value corresponding to the given key.
             
             See __setitem__ for test cases.
+
+            >>> t = Trie()
+            >>> t["a" * 5000] = 1
+            >>> t["a" * 5000]
+            1
+            >>> ("a" * 4999) in t
+            False
         """
 
-        if len(key) == 0:
-            if self.has_value:
-                return self.value
-            else:
-                raise KeyError(key)
-        else:
-            try:
-                subtrie = self.nodes[key[0]]
-                return subtrie[key[1:]]
-            except KeyError as e:
-                raise KeyError(key)
+        node = self._find(key)
+        if node is None or not node.has_value:
+            raise KeyError(key)
+        return node.value
 
     def __setitem__(self, key, value):
         """ Set the key/value pair in the Trie.
@@ -42,13 +106,22 @@ class Trie:
         >>> t[key[:3]]
         2
         """
-        if len(key) == 0:
-            self.has_value = True
-            self.value = value
-        else:
-            subtrie = self.nodes.get(key[0], Trie())
-            self.nodes[key[0]] = subtrie
-            subtrie[key[1:]] = value
+        node = self
+        path = [self]
+        for char in key:
+            node.best = None
+            subtrie = node.nodes.get(char)
+            if subtrie is None:
+                subtrie = Trie()
+                node.nodes[char] = subtrie
+            node = subtrie
+            path.append(node)
+        node.best = None
+        if not node.has_value:
+            for subtrie in path:
+                subtrie.size += 1
+        node.has_value = True
+        node.value = value
 
     def __delitem__(self, key):
         """ Delete the given key from the trie.
@@ -67,20 +140,37 @@ class Trie:
         >>> del t[""]
         Traceback (most recent call last):
         KeyError: ''
+
+        Emptied subtries are removed.
+        >>> t["tea"] = 1
+        >>> t["ten"] = 2
+        >>> del t["tea"]
+        >>> sorted(t.nodes["t"].nodes["e"].nodes)
+        ['n']
+        >>> del t["ten"]
+        >>> t.nodes, len(t)
+        ({}, 0)
         """
-        if len(key) == 0:
-            if self.has_value:
-                self.has_value = False
-                self.value = None
-            else:
-                raise KeyError(key)
-        else:
-            # FIXME: We don't clean up hanging nodes here...
-            try:
-                subtrie = self.nodes[key[0]]
-                del subtrie[key[1:]]
-            except KeyError:
+        node = self
+        path = [self] # path[i] is the node for key[:i].
+        for char in key:
+            node = node.nodes.get(char)
+            if node is None:
                 raise KeyError(key)
+            path.append(node)
+        if not node.has_value:
+            raise KeyError(key)
+        node.has_value = False
+        node.value = None
+
+        # Update the counts down the path, and prune the first subtrie left
+        # without any keys.
+        for i, subtrie in enumerate(path):
+            subtrie.size -= 1
+            subtrie.best = None
+            if subtrie.size == 0 and i > 0:
+                del path[i - 1].nodes[key[i - 1]]
+                break
 
     def __contains__(self, key):
         """
@@ -96,11 +186,32 @@ class Trie:
         >>> key[:4] in t
         False
         """
-        try:
-            self.__getitem__(key)
-            return True
-        except KeyError:
-            return False
+        node = self._find(key)
+        return node is not None and bool(node.has_value)
+
+    def __len__(self):
+        """
+        >>> t = Trie()
+        >>> t["a"] = 1
+        >>> t["ab"] = 2
+        >>> t["a"] = 3
+        >>> len(t)
+        2
+        """
+        return self.size
+
+    def count(self, prefix=''):
+        """ Return the number of keys starting with prefix.
+
+            >>> t = Trie.from_sorted([("a", 1), ("ab", 2), ("b", 3)])
+            >>> t.count("a"), t.count("ab"), t.count("c"), t.count()
+            (2, 1, 0, 3)
+        """
+
+        node, _ = self._locate(prefix)
+        if node is None:
+            return 0
+        return node.size
 
     def __iter__(self):
         """
@@ -123,13 +234,1137 @@ class Trie:
         :test 3a
 
         """
-        if self.has_value:
-            yield ''
-        
-        for k, v in self.nodes.items():
-            for subkey in v:
-                yield k + subkey
-    
+        return self.keys()
+
+    def items(self, prefix=''):
+        """ Iterate over the (key, value) pairs with keys starting with prefix.
+
+            Keys are rebuilt from a stack of edge labels, so each key costs
+            time proportional to its length rather than its length squared.
+
+            >>> t = Trie()
+            >>> t["tea"] = 1
+            >>> t["ten"] = 2
+            >>> t["to"] = 3
+            >>> sorted(t.items("te"))
+            [('tea', 1), ('ten', 2)]
+            >>> sorted(t.items())
+            [('tea', 1), ('ten', 2), ('to', 3)]
+            >>> list(t.items("x"))
+            []
+        """
+
+        node, key = self._locate(prefix)
+        if node is None:
+            return
+        path = []
+        stack = [(node, key, 0)]
+        while stack:
+            node, label, depth = stack.pop()
+            del path[depth:]
+            path.append(label)
+            if node.has_value:
+                yield ''.join(path), node.value
+            for label, subtrie in node._edges():
+                stack.append((subtrie, label, depth + 1))
+
+    def keys(self, prefix=''):
+        """ Iterate over the keys starting with prefix.
+
+            >>> t = Trie()
+            >>> t["tea"] = 1
+            >>> t["ten"] = 2
+            >>> t["to"] = 3
+            >>> sorted(t.keys("t"))
+            ['tea', 'ten', 'to']
+            >>> sorted(t.keys("ten"))
+            ['ten']
+        """
+
+        for key, _ in self.items(prefix):
+            yield key
+
+    def _prefix_nodes(self, string):
+        """ Yield (length, node) for each node on the path spelt out by the
+            start of string, including the root.
+        """
+
+        node = self
+        yield 0, node
+        for i, char in enumerate(string):
+            node = node.nodes.get(char)
+            if node is None:
+                return
+            yield i + 1, node
+
+    def prefixes(self, string):
+        """ Yield the (key, value) pairs whose keys are prefixes of string,
+            shortest first, in a single walk down the trie.
+
+            >>> t = Trie()
+            >>> for key in ["/", "/api", "/api/v1", "/static"]:
+            ...     t[key] = len(key)
+            >>> list(t.prefixes("/api/v1/users"))
+            [('/', 1), ('/api', 4), ('/api/v1', 7)]
+            >>> list(t.prefixes("api"))
+            []
+        """
+
+        for length, node in self._prefix_nodes(string):
+            if node.has_value:
+                yield string[:length], node.value
+
+    def longest_prefix(self, string):
+        """ Return the (key, value) pair for the longest key which is a
+            prefix of string.
+
+            >>> t = Trie()
+            >>> t["/api"] = 1
+            >>> t["/api/v1"] = 2
+            >>> t.longest_prefix("/api/v1/users")
+            ('/api/v1', 2)
+            >>> t.longest_prefix("/api/v2")
+            ('/api', 1)
+            >>> t.longest_prefix("/static")
+            Traceback (most recent call last):
+            KeyError: '/static'
+        """
+
+        best = None
+        for length, node in self._prefix_nodes(string):
+            if node.has_value:
+                best = length, node.value
+        if best is None:
+            raise KeyError(string)
+        return string[:best[0]], best[1]
+
+    def matcher(self):
+        """ Return a Matcher for finding the current keys in longer texts """
+
+        return Matcher(self.items())
+
+    def scan(self, text):
+        """ Yield (start, end, value) for every occurrence of a key in text.
+
+            This builds a new Matcher on each call; when scanning many texts
+            against the same keys, build one with matcher() and reuse it.
+
+            >>> t = Trie()
+            >>> t["he"] = 1
+            >>> t["she"] = 2
+            >>> sorted(t.scan("ushers"))
+            [(1, 4, 2), (2, 4, 1)]
+        """
+
+        return self.matcher().scan(text)
+
+    def fuzzy(self, query, max_dist):
+        """ Lazily yield (key, value, distance) for every key within edit
+            distance max_dist of query.
+
+            The trie is walked once, carrying one row of the Levenshtein
+            table per node, so keys sharing a prefix share the work; any
+            subtrie whose row minimum exceeds max_dist is skipped.
+
+            >>> t = Trie()
+            >>> for word in ["cat", "cart", "cut", "dog", "at", "scat"]:
+            ...     t[word] = word.upper()
+            >>> for match in sorted(t.fuzzy("cat", 1)): print(match)
+            ('at', 'AT', 1)
+            ('cart', 'CART', 1)
+            ('cat', 'CAT', 0)
+            ('cut', 'CUT', 1)
+            ('scat', 'SCAT', 1)
+            >>> sorted(key for key, _, _ in t.fuzzy("dot", 1))
+            ['dog']
+            >>> list(t.fuzzy("xyz", 0))
+            []
+            >>> r = RadixTrie.from_mapping(t)
+            >>> sorted(r.fuzzy("cat", 1)) == sorted(t.fuzzy("cat", 1))
+            True
+        """
+
+        columns = range(1, len(query) + 1)
+        path = []
+        stack = [(self, '', 0, list(range(len(query) + 1)))]
+        while stack:
+            node, label, depth, row = stack.pop()
+            for char in label:
+                previous = row
+                row = [previous[0] + 1]
+                for column in columns:
+                    row.append(min(row[column - 1] + 1,
+                        previous[column] + 1,
+                        previous[column - 1] + (query[column - 1] != char)))
+                if min(row) > max_dist:
+                    break
+            else:
+                del path[depth:]
+                path.append(label)
+                if node.has_value and row[-1] <= max_dist:
+                    yield ''.join(path), node.value, row[-1]
+                for label, subtrie in node._edges():
+                    stack.append((subtrie, label, depth + 1, row))
+
+    def _subtrie_best(self, score):
+        """ Return the best score of any value in this subtrie, or None.
+
+            Scores are cached on each node (see self.best) for the given
+            scoring function, so repeated queries only revisit the paths
+            changed since the last one.
+        """
+
+        stack = [(self, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if node.best is not None and node.best[0] is score:
+                continue
+            if not expanded:
+                stack.append((node, True))
+                stack.extend((subtrie, False) \
+                        for subtrie in node.nodes.values())
+                continue
+            best = score(node.value) if node.has_value else None
+            for subtrie in node.nodes.values():
+                sub_best = subtrie.best[1]
+                if sub_best is not None and (best is None or sub_best > best):
+                    best = sub_best
+            node.best = (score, best)
+        return self.best[1]
+
+    def complete(self, prefix, k, key=None):
+        """ Return the k best (key, value) pairs with keys starting with
+            prefix, best first.
+
+            Values are ranked by key(value), or by the value itself if no key
+            function is given. Scores must be numbers. The search is
+            best-first over the cached per-node maxima, so only the branches
+            that can contribute to the result are visited.
+            Passing the same key function object lets the cache be reused
+            between calls.
+
+            >>> t = Trie()
+            >>> for word, freq in [("car", 5), ("cat", 9), ("cart", 7),
+            ...         ("dog", 10), ("ca", 1)]:
+            ...     t[word] = freq
+            >>> t.complete("ca", 2)
+            [('cat', 9), ('cart', 7)]
+            >>> t.complete("", 1)
+            [('dog', 10)]
+            >>> t.complete("ca", 3, key=lambda v: -v)
+            [('ca', 1), ('car', 5), ('cart', 7)]
+            >>> t.complete("", 2)
+            [('dog', 10), ('cat', 9)]
+            >>> t["cab"] = 20
+            >>> t.complete("c", 1)
+            [('cab', 20)]
+            >>> del t["cab"]
+            >>> t.complete("c", 1)
+            [('cat', 9)]
+            >>> t.complete("x", 3)
+            []
+        """
+
+        if key is None:
+            key = _identity
+        node, base = self._locate(prefix)
+        if node is None or k <= 0:
+            return []
+        best = node._subtrie_best(key)
+        if best is None:
+            return []
+
+        # Entries are (-score, tie breaker, key, node, is a value); a value
+        # entry is only popped once no unexplored branch can beat it.
+        results = []
+        counter = 0
+        heap = [(-best, counter, base, node, False)]
+        while heap and len(results) < k:
+            _, _, path, node, is_value = heappop(heap)
+            if is_value:
+                results.append((path, node.value))
+                continue
+            if node.has_value:
+                counter += 1
+                heappush(heap, (-key(node.value), counter, path, node, True))
+            for label, subtrie in node._edges():
+                # Another key function may have replaced this node's cache
+                # since the parent was scored, so check it first.
+                sub_best = subtrie._subtrie_best(key)
+                if sub_best is not None:
+                    counter += 1
+                    heappush(heap, (-sub_best, counter, path + label,
+                        subtrie, False))
+        return results
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """ Build a new trie holding the same key/value pairs as mapping """
+
+        trie = cls()
+        for key in mapping:
+            trie[key] = mapping[key]
+        return trie
+
+    @classmethod
+    def from_sorted(cls, pairs):
+        """ Build a new trie from an iterable of (key, value) pairs in sorted
+            key order, in a single pass.
+
+            The path to the previous key is kept on a stack, so each key only
+            walks and allocates the part that differs from its predecessor.
+            The pairs are consumed lazily and may come from a generator.
+            Repeated keys keep the last value.
+
+            >>> t = Trie.from_sorted((k, len(k)) for k in ["a", "ab", "abc",
+            ...         "abd", "b", "b"])
+            >>> sorted(t.items())
+            [('a', 1), ('ab', 2), ('abc', 3), ('abd', 3), ('b', 1)]
+            >>> Trie.from_sorted([("b", 1), ("a", 2)])
+            Traceback (most recent call last):
+            ValueError: Keys are not sorted: 'a' follows 'b'
+        """
+
+        trie = cls()
+        previous = None
+        path = [trie] # path[i] is the node for previous[:i].
+        for key, value in pairs:
+            if previous is not None:
+                if key < previous:
+                    raise ValueError("Keys are not sorted: {!r} follows {!r}"\
+                            .format(key, previous))
+                common = 0
+                limit = min(len(key), len(previous))
+                while common < limit and key[common] == previous[common]:
+                    common += 1
+                del path[common + 1:]
+
+            node = path[-1]
+            for i in range(len(path) - 1, len(key)):
+                subtrie = Trie()
+                node.nodes[key[i]] = subtrie
+                path.append(subtrie)
+                node = subtrie
+            if not node.has_value:
+                for subtrie in path:
+                    subtrie.size += 1
+            node.has_value = True
+            node.value = value
+            previous = key
+        return trie
+
+    @classmethod
+    def from_unsorted(cls, pairs, chunk_size=None):
+        """ Build a new trie from (key, value) pairs in any order.
+
+            The pairs are sorted externally: each chunk of chunk_size pairs
+            is sorted in memory and spilled to a temporary file, and the
+            sorted runs are then merged lazily into from_sorted. If pairs
+            repeat a key, the last one wins.
+
+            >>> pairs = [("b", 1), ("a", 2), ("c", 3), ("a", 4), ("ab", 5)]
+            >>> sorted(Trie.from_unsorted(pairs, chunk_size=2).items())
+            [('a', 4), ('ab', 5), ('b', 1), ('c', 3)]
+        """
+
+        if chunk_size is None:
+            chunk_size = SORT_CHUNK_SIZE
+
+        runs = []
+        try:
+            chunk = []
+            for pair in pairs:
+                chunk.append(pair)
+                if len(chunk) >= chunk_size:
+                    runs.append(_spill_run(chunk))
+                    chunk = []
+            if chunk:
+                runs.append(_spill_run(chunk))
+            # merge is stable, so equal keys come out in input order.
+            return cls.from_sorted(merge(*(_read_run(run) for run in runs),
+                key=itemgetter(0)))
+        finally:
+            for run in runs:
+                run.close()
+
+    def nbytes(self):
+        """ Return the number of bytes used by the trie structure itself.
+
+            Stored values are not included, as they are owned by the caller.
+        """
+
+        total = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            total += sys.getsizeof(node) + sys.getsizeof(node.nodes)
+            stack.extend(node.nodes.values())
+        return total
+
+    def bytes_per_key(self):
+        """ Return the average structure size per stored key.
+
+            >>> t = Trie()
+            >>> t.bytes_per_key()
+            0.0
+            >>> t["abc"] = 1
+            >>> t.bytes_per_key() == t.nbytes()
+            True
+        """
+
+        if self.size == 0:
+            return 0.0
+        return self.nbytes() / self.size
+
+    def save(self, path):
+        """ Write the trie to path in the flat format read by MappedTrie.
+
+            Keys must be strings, and values must be picklable.
+            Nodes are numbered breadth-first, and the children of each node
+            are written as a contiguous run of edges sorted by character, so
+            the file holds no pointers, only array indices.
+        """
+
+        first = array('I', [0])
+        node_values = array('i')
+        labels = array('I')
+        children = array('I')
+        value_offsets = array('Q', [0])
+        blobs = []
+
+        queue = deque([self])
+        count = 1
+        while queue:
+            node = queue.popleft()
+            if node.has_value:
+                blob = pickle.dumps(node.value, pickle.HIGHEST_PROTOCOL)
+                node_values.append(len(blobs))
+                blobs.append(blob)
+                value_offsets.append(value_offsets[-1] + len(blob))
+            else:
+                node_values.append(-1)
+            for char in sorted(node.nodes):
+                labels.append(ord(char))
+                children.append(count)
+                queue.append(node.nodes[char])
+                count += 1
+            first.append(len(labels))
+
+        sections = [first, node_values, labels, children, value_offsets]
+        if sys.byteorder != 'little':
+            for section in sections:
+                section.byteswap()
+        with open(path, 'wb') as f:
+            f.write(MAPPED_HEADER.pack(MAPPED_MAGIC, len(node_values),
+                len(labels), len(blobs)))
+            for section in sections:
+                section.tofile(f)
+                f.write(bytes(-f.tell() % 8)) # Keep sections aligned.
+            for blob in blobs:
+                f.write(blob)
+
+
+def _spill_run(chunk):
+    """ Sort the given pairs by key and write them to a temporary file """
+
+    chunk.sort(key=itemgetter(0))
+    run = tempfile.TemporaryFile()
+    for i in range(0, len(chunk), SPILL_BLOCK_SIZE):
+        pickle.dump(chunk[i:i + SPILL_BLOCK_SIZE], run,
+                pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    """ Yield the pairs written to the given file by _spill_run """
+
+    while True:
+        try:
+            block = pickle.load(run)
+        except EOFError:
+            return
+        yield from block
+
+
+class RadixTrie(Trie):
+    """ Path-compressed (radix) trie.
+
+        Each node stores the whole label of the edge leading into it, so
+        chains of single-child nodes collapse into one node. Edges are split
+        on insert when a key diverges part way along a label, and merged
+        back together on delete.
+
+        >>> t = RadixTrie()
+        >>> key = "some test string"
+        >>> t[key] = 100
+        >>> t[key]
+        100
+        >>> t[""] = 1
+        >>> t[""]
+        1
+        >>> t[key]
+        100
+        >>> t[key[:3]] = 2
+        >>> t[key[:3]]
+        2
+        >>> t[key], key in t, key[:4] in t, "not in t" in t
+        (100, True, False, False)
+        >>> del t[key]
+        >>> t[key]
+        Traceback (most recent call last):
+        KeyError: 'some test string'
+        >>> del t["never existed"]
+        Traceback (most recent call last):
+        KeyError: 'never existed'
+        >>> del t[""]
+        >>> del t[""]
+        Traceback (most recent call last):
+        KeyError: ''
+        >>> t = RadixTrie()
+        >>> t["test 1"] = 1
+        >>> t["test 2"] = 2
+        >>> t["test 3a"] = 3
+        >>> t["test"] = 4
+        >>> for k in sorted(list(t)): print(k)
+        test
+        test 1
+        test 2
+        test 3a
+        >>> t[""] = 5
+        >>> for k in sorted(list(t)): print(":" + k)
+        :
+        :test
+        :test 1
+        :test 2
+        :test 3a
+        >>> t.node_count()
+        6
+        >>> del t["test"]
+        >>> del t["test 1"]
+        >>> sorted(t), t.node_count()
+        (['', 'test 2', 'test 3a'], 4)
+        >>> len(t), t.count("test"), t.count("tes"), t.count("test 3")
+        (3, 2, 2, 1)
+    """
+
+    __slots__ = ('label',)
+
+    def __init__(self, label=''):
+        super().__init__()
+        self.label = label
+
+    def _find(self, key):
+        """ Return the node exactly matching the given key, or None """
+
+        node = self
+        i = 0
+        while i < len(key):
+            node = node.nodes.get(key[i])
+            if node is None or not key.startswith(node.label, i):
+                return None
+            i += len(node.label)
+        return node
+
+    def _locate(self, prefix):
+        """ Return the first node whose key starts with prefix, along with the
+            full key of that node; the prefix may end part way along an edge.
+
+            >>> t = RadixTrie()
+            >>> t["tea"] = 1
+            >>> t["ten"] = 2
+            >>> sorted(t.keys("t")), sorted(t.items("tea"))
+            (['tea', 'ten'], [('tea', 1)])
+            >>> t.complete("t", 1)
+            [('ten', 2)]
+            >>> t._locate("t")[1], t._locate("x")
+            ('te', (None, None))
+        """
+
+        node = self
+        i = 0
+        while i < len(prefix):
+            node = node.nodes.get(prefix[i])
+            if node is None:
+                return None, None
+            label = node.label
+            if not prefix.startswith(label, i):
+                # The prefix may stop part way along this edge.
+                if label.startswith(prefix[i:]):
+                    return node, prefix[:i] + label
+                return None, None
+            i += len(label)
+        return node, prefix
+
+    def _edges(self):
+        return ((child.label, child) for child in self.nodes.values())
+
+    def _prefix_nodes(self, string):
+        """ Yield (length, node) for each node whose key is a prefix of string
+
+            >>> t = RadixTrie()
+            >>> t["/api"] = 1
+            >>> t["/api/v1"] = 2
+            >>> t["/apis"] = 3
+            >>> list(t.prefixes("/api/v1/users"))
+            [('/api', 1), ('/api/v1', 2)]
+            >>> t.longest_prefix("/api/v")
+            ('/api', 1)
+        """
+
+        node = self
+        i = 0
+        yield 0, node
+        while i < len(string):
+            node = node.nodes.get(string[i])
+            if node is None or not string.startswith(node.label, i):
+                return
+            i += len(node.label)
+            yield i, node
+
+    @classmethod
+    def from_sorted(cls, pairs):
+        """ Build a new radix trie from (key, value) pairs in sorted order.
+
+            Edges are split as keys diverge, so this simply inserts each key.
+
+            >>> sorted(RadixTrie.from_sorted([("ab", 1), ("ac", 2)]).items())
+            [('ab', 1), ('ac', 2)]
+        """
+
+        trie = cls()
+        previous = None
+        for key, value in pairs:
+            if previous is not None and key < previous:
+                raise ValueError("Keys are not sorted: {!r} follows {!r}"\
+                        .format(key, previous))
+            trie[key] = value
+            previous = key
+        return trie
+
+    def __setitem__(self, key, value):
+        node = self
+        path = [self]
+        i = 0
+        while i < len(key):
+            node.best = None
+            child = node.nodes.get(key[i])
+            if child is None:
+                child = RadixTrie(key[i:])
+                node.nodes[key[i]] = child
+                node = child
+                path.append(node)
+                break
+
+            # Find how much of the edge label the key shares.
+            label = child.label
+            j = 1
+            while j < len(label) and i + j < len(key) \
+                    and label[j] == key[i + j]:
+                j += 1
+            if j < len(label):
+                # Split the edge at the point where the key diverges.
+                middle = RadixTrie(label[:j])
+                middle.size = child.size
+                child.label = label[j:]
+                middle.nodes[label[j]] = child
+                node.nodes[key[i]] = middle
+                child = middle
+            node = child
+            path.append(node)
+            i += j
+
+        node.best = None
+        if not node.has_value:
+            for child in path:
+                child.size += 1
+        node.has_value = True
+        node.value = value
+
+    def __delitem__(self, key):
+        parents = []
+        node = self
+        i = 0
+        while i < len(key):
+            child = node.nodes.get(key[i])
+            if child is None or not key.startswith(child.label, i):
+                raise KeyError(key)
+            parents.append(node)
+            node = child
+            i += len(child.label)
+        if not node.has_value:
+            raise KeyError(key)
+        node.has_value = False
+        node.value = None
+        node.best = None
+        node.size -= 1
+        for parent in parents:
+            parent.best = None
+            parent.size -= 1
+
+        # Remove a now-empty leaf, then merge whatever is left with its only
+        # child so that no valueless single-child node remains.
+        if parents and not node.nodes:
+            parent = parents.pop()
+            del parent.nodes[node.label[0]]
+            node = parent
+        if parents and not node.has_value and len(node.nodes) == 1:
+            child, = node.nodes.values()
+            child.label = node.label + child.label
+            parents[-1].nodes[child.label[0]] = child
+
+    def node_count(self):
+        """ Return the number of nodes in the trie, including the root """
+
+        count = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            count += 1
+            stack.extend(node.nodes.values())
+        return count
+
+    def save(self, path):
+        """ Write the trie to path in the flat format read by MappedTrie.
+
+            The mapped format has one character per edge, so the labels are
+            expanded by rebuilding the keys as a plain Trie first.
+        """
+
+        Trie.from_sorted(sorted(self.items())).save(path)
+
+
+class Matcher:
+    """ Aho-Corasick automaton for finding many keys in a text at once.
+
+        The automaton is a trie of the keys with a failure link on each node,
+        pointing to the node for the longest proper suffix of its key which
+        is also in the trie, and an output link to the nearest such suffix
+        node holding a key. A scan then reads each character of the text
+        once, however many keys there are.
+        The matcher is a snapshot; later changes to the source trie are not
+        seen.
+
+        >>> m = Matcher([("he", 1), ("she", 2), ("his", 3), ("hers", 4)])
+        >>> sorted(m.scan("ushers"))
+        [(1, 4, 2), (2, 4, 1), (2, 6, 4)]
+        >>> list(m.scan("xyz"))
+        []
+        >>> sorted(Matcher([("a", 1), ("aa", 2)]).scan("aaa"))
+        [(0, 1, 1), (0, 2, 2), (1, 2, 1), (1, 3, 2), (2, 3, 1)]
+    """
+
+    def __init__(self, pairs):
+        """ Build the automaton from an iterable of (key, value) pairs.
+
+            Empty keys are ignored, as they would match everywhere.
+        """
+
+        # Node i has goto edges self._goto[i], and holds the key with length
+        # self._lengths[i] and value self._values[i] if it has a value.
+        self._goto = [{}]
+        self._has_value = [False]
+        self._values = [None]
+        self._lengths = [0]
+        for key, value in pairs:
+            if not key:
+                continue
+            node = 0
+            for char in key:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto.append({})
+                    self._has_value.append(False)
+                    self._values.append(None)
+                    self._lengths.append(self._lengths[node] + 1)
+                    self._goto[node][char] = child
+                node = child
+            self._has_value[node] = True
+            self._values[node] = value
+
+        # Set the failure and output links breadth first, so the links of
+        # every shorter suffix are known before they are needed.
+        self._fail = [0] * len(self._goto)
+        self._output = [-1] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            fail = self._fail[node]
+            self._output[node] = fail if self._has_value[fail] \
+                    else self._output[fail]
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                if node == 0:
+                    continue
+                state = fail
+                while state and char not in self._goto[state]:
+                    state = self._fail[state]
+                self._fail[child] = self._goto[state].get(char, 0)
+
+    def scan(self, text):
+        """ Yield (start, end, value) for every key found in text, where
+            text[start:end] is the key.
+        """
+
+        goto = self._goto
+        fail = self._fail
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            match = node if self._has_value[node] else self._output[node]
+            while match > 0:
+                yield i + 1 - self._lengths[match], i + 1, self._values[match]
+                match = self._output[match]
+
+
+class CompactTrie:
+    """ Trie stored as a flat array of nodes.
+
+        Node i is described by entry i of a set of parallel arrays: the
+        character on the edge leading into it, its first child and its next
+        sibling (-1 for none), and whether it holds a value.
+        Children are kept as a linked list of siblings, so there are no
+        per-node objects or dicts; this trades a short linear scan per
+        character for a much smaller memory footprint.
+        Keys must be strings.
+
+        >>> t = CompactTrie()
+        >>> t["test 1"] = 1
+        >>> t["test 2"] = 2
+        >>> t["test"] = 3
+        >>> t["test 2"]
+        2
+        >>> t["test 2"] = 4
+        >>> t["test 2"]
+        4
+        >>> "tes" in t, "test" in t
+        (False, True)
+        >>> len(t)
+        3
+        >>> del t["test"]
+        >>> t["test"]
+        Traceback (most recent call last):
+        KeyError: 'test'
+        >>> del t["test"]
+        Traceback (most recent call last):
+        KeyError: 'test'
+        >>> for k in sorted(t): print(k)
+        test 1
+        test 2
+        >>> t[""] = 5
+        >>> for k in sorted(t): print(":" + k)
+        :
+        :test 1
+        :test 2
+        >>> t.bytes_per_key() < Trie.from_mapping(t).bytes_per_key()
+        True
+
+        Nodes freed by deleting keys are reused by later insertions:
+
+        >>> nodes = len(t._labels)
+        >>> for i in range(100):
+        ...     t["churn {}".format(i)] = i
+        ...     del t["churn {}".format(i)]
+        >>> len(t._labels) - nodes, sorted(t)
+        (8, ['', 'test 1', 'test 2'])
+    """
+
+    def __init__(self):
+        self._labels = array('l', [0])
+        self._children = array('l', [-1])
+        self._siblings = array('l', [-1])
+        self._has_value = bytearray(1)
+        self._values = [None]
+        self._size = 0
+        self._free = [] # Nodes removed by __delitem__, to be reused.
+
+    def _child(self, node, char):
+        """ Return the child of node along the edge char, or -1 """
+
+        label = ord(char)
+        child = self._children[node]
+        labels = self._labels
+        siblings = self._siblings
+        while child != -1 and labels[child] != label:
+            child = siblings[child]
+        return child
+
+    def _find(self, key):
+        """ Return the index of the node reached by walking the key, or -1 """
+
+        node = 0
+        for char in key:
+            node = self._child(node, char)
+            if node == -1:
+                return -1
+        return node
+
+    def __getitem__(self, key):
+        node = self._find(key)
+        if node == -1 or not self._has_value[node]:
+            raise KeyError(key)
+        return self._values[node]
+
+    def __setitem__(self, key, value):
+        node = 0
+        for char in key:
+            child = self._child(node, char)
+            if child == -1:
+                # Push the new node onto the front of the sibling list.
+                if self._free:
+                    child = self._free.pop()
+                    self._labels[child] = ord(char)
+                    self._children[child] = -1
+                    self._siblings[child] = self._children[node]
+                else:
+                    child = len(self._labels)
+                    self._labels.append(ord(char))
+                    self._children.append(-1)
+                    self._siblings.append(self._children[node])
+                    self._has_value.append(0)
+                    self._values.append(None)
+                self._children[node] = child
+            node = child
+        if not self._has_value[node]:
+            self._has_value[node] = 1
+            self._size += 1
+        self._values[node] = value
+
+    def __delitem__(self, key):
+        path = [0]
+        for char in key:
+            node = self._child(path[-1], char)
+            if node == -1:
+                raise KeyError(key)
+            path.append(node)
+        node = path[-1]
+        if not self._has_value[node]:
+            raise KeyError(key)
+        self._has_value[node] = 0
+        self._values[node] = None
+        self._size -= 1
+
+        # Unlink the nodes left with no value and no children, from the
+        # end of the key back, and keep them for reuse.
+        children = self._children
+        siblings = self._siblings
+        for depth in range(len(path) - 1, 0, -1):
+            node = path[depth]
+            if self._has_value[node] or children[node] != -1:
+                break
+            parent = path[depth - 1]
+            if children[parent] == node:
+                children[parent] = siblings[node]
+            else:
+                previous = children[parent]
+                while siblings[previous] != node:
+                    previous = siblings[previous]
+                siblings[previous] = siblings[node]
+            self._free.append(node)
+
+    def __contains__(self, key):
+        node = self._find(key)
+        return node != -1 and bool(self._has_value[node])
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        # Rebuild keys from a stack of edge labels, as for Trie.items.
+        path = []
+        stack = [(0, '', 0)]
+        while stack:
+            node, label, depth = stack.pop()
+            del path[depth:]
+            path.append(label)
+            if self._has_value[node]:
+                yield ''.join(path)
+            child = self._children[node]
+            while child != -1:
+                stack.append((child, chr(self._labels[child]), depth + 1))
+                child = self._siblings[child]
+
+    def nbytes(self):
+        """ Return the number of bytes used by the trie structure itself """
+
+        return sum(sys.getsizeof(a) for a in (self._labels, self._children,
+            self._siblings, self._has_value, self._values))
+
+    def bytes_per_key(self):
+        """ Return the average structure size per stored key """
+
+        if self._size == 0:
+            return 0.0
+        return self.nbytes() / self._size
+
+
+class MappedTrie:
+    """ Read-only trie answering queries directly from a file written by
+        Trie.save, through mmap.
+
+        Nothing is deserialised up front, so opening is instant however large
+        the trie, and processes mapping the same file share its pages.
+        After the header the file holds, each padded to 8 bytes:
+
+        - first: uint32[nodes + 1]; the edges of node i are first[i] up to
+          first[i + 1].
+        - node_values: int32[nodes]; index into the values, or -1.
+        - labels: uint32[edges]; edge characters, sorted within each node.
+        - children: uint32[edges]; the node at the end of each edge.
+        - value_offsets: uint64[values + 1]; bounds of each pickled value.
+        - the pickled values themselves.
+
+        >>> import os
+        >>> t = Trie()
+        >>> t["tea"] = 1
+        >>> t["ten"] = [2]
+        >>> t[""] = 3
+        >>> directory = tempfile.TemporaryDirectory()
+        >>> path = os.path.join(directory.name, "test.trie")
+        >>> t.save(path)
+        >>> m = MappedTrie.open(path)
+        >>> m["ten"], m[""], "te" in m, "tea" in m, len(m)
+        ([2], 3, False, True, 3)
+        >>> sorted(m.items("te")), sorted(m)
+        ([('tea', 1), ('ten', [2])], ['', 'tea', 'ten'])
+        >>> m["te"]
+        Traceback (most recent call last):
+        KeyError: 'te'
+        >>> m.close()
+        >>> RadixTrie.from_mapping(t).save(path)
+        >>> with MappedTrie.open(path) as m:
+        ...     sorted(m.items())
+        [('', 3), ('tea', 1), ('ten', [2])]
+        >>> directory.cleanup()
+    """
+
+    def __init__(self, buffer, close=None):
+        """ Wrap the given buffer holding a saved trie.
+
+            close, if given, is called when the trie is closed.
+        """
+
+        if sys.byteorder != 'little':
+            raise ValueError("Mapped tries are only supported on " \
+                    "little-endian hosts")
+        magic, nodes, edges, values = MAPPED_HEADER.unpack_from(buffer)
+        if magic != MAPPED_MAGIC:
+            raise ValueError("Not a saved trie")
+
+        self._buffer = memoryview(buffer)
+        self._close = close
+        self._size = values
+        offset = MAPPED_HEADER.size
+        sections = []
+        for code, length in (('I', nodes + 1), ('i', nodes), ('I', edges),
+                ('I', edges), ('Q', values + 1)):
+            end = offset + length * struct.calcsize(code)
+            sections.append(self._buffer[offset:end].cast(code))
+            offset = end + (-end % 8)
+        self._first, self._node_values, self._labels, self._children, \
+                self._value_offsets = sections
+        self._blobs = offset
+
+    @classmethod
+    def open(cls, path):
+        """ Map the trie saved at path """
+
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapping, mapping.close)
+
+    def close(self):
+        """ Release the underlying buffer """
+
+        for view in (self._first, self._node_values, self._labels,
+                self._children, self._value_offsets, self._buffer):
+            view.release()
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _find(self, key):
+        """ Return the index of the node reached by walking the key, or -1 """
+
+        first = self._first
+        labels = self._labels
+        node = 0
+        for char in key:
+            label = ord(char)
+            hi = first[node + 1]
+            edge = bisect_left(labels, label, first[node], hi)
+            if edge == hi or labels[edge] != label:
+                return -1
+            node = self._children[edge]
+        return node
+
+    def _value(self, index):
+        """ Unpickle the value with the given index """
+
+        start = self._blobs + self._value_offsets[index]
+        end = self._blobs + self._value_offsets[index + 1]
+        return pickle.loads(self._buffer[start:end])
+
+    def __getitem__(self, key):
+        node = self._find(key)
+        if node == -1 or self._node_values[node] == -1:
+            raise KeyError(key)
+        return self._value(self._node_values[node])
+
+    def __contains__(self, key):
+        node = self._find(key)
+        return node != -1 and self._node_values[node] != -1
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return self.keys()
+
+    def _walk(self, prefix):
+        """ Iterate over (key, value index) for the keys starting with prefix,
+            without unpickling any values.
+        """
+
+        node = self._find(prefix)
+        if node == -1:
+            return
+        first = self._first
+        path = []
+        stack = [(node, prefix, 0)]
+        while stack:
+            node, label, depth = stack.pop()
+            del path[depth:]
+            path.append(label)
+            index = self._node_values[node]
+            if index != -1:
+                yield ''.join(path), index
+            for edge in range(first[node], first[node + 1]):
+                stack.append((self._children[edge], chr(self._labels[edge]),
+                    depth + 1))
+
+    def items(self, prefix=''):
+        """ Iterate over the (key, value) pairs with keys starting with prefix """
+
+        for key, index in self._walk(prefix):
+            yield key, self._value(index)
+
+    def keys(self, prefix=''):
+        """ Iterate over the keys starting with prefix """
+
+        for key, _ in self._walk(prefix):
+            yield key
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
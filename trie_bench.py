@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+""" Benchmarks for trie.py.
+
+    Generates reproducible synthetic key sets, times the main operations on
+    each trie implementation, and measures memory use. The results are
+    printed as a table and can be written as JSON for comparing versions:
+
+        python3 trie_bench.py --sizes 10000 100000 --json before.json
+
+    Author: Alastair Hughes
+"""
+
+import argparse
+import gc
+import multiprocessing
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # Not available on Windows.
+    resource = None
+
+import trie
+
+IMPLEMENTATIONS = {
+    'Trie': trie.Trie,
+    'RadixTrie': trie.RadixTrie,
+    'CompactTrie': trie.CompactTrie,
+}
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+WORD_LETTERS = 'etaoinshrdlcumwfgypbvkjxqz'
+URL_HOSTS = ['example.com', 'www.example.org', 'api.example.net',
+        'static.cdn.example.com', 'localhost:8080']
+URL_SEGMENTS = ['api', 'v1', 'v2', 'users', 'items', 'search', 'static',
+        'images', 'css', 'js', 'admin', 'login', 'orders', 'products']
+
+
+def url_keys(rng, count):
+    """ Generate URL-like keys with long shared prefixes """
+
+    keys = set()
+    while len(keys) < count:
+        segments = [rng.choice(URL_SEGMENTS) \
+                for _ in range(rng.randint(1, 4))]
+        segments.append(str(rng.randrange(100000)))
+        keys.add('https://{}/{}'.format(rng.choice(URL_HOSTS),
+            '/'.join(segments)))
+    return list(keys)
+
+
+def word_keys(rng, count):
+    """ Generate dictionary-like words, skewed towards common letters """
+
+    weights = [len(WORD_LETTERS) - i for i in range(len(WORD_LETTERS))]
+    keys = set()
+    while len(keys) < count:
+        length = rng.randint(2, 14)
+        keys.add(''.join(rng.choices(WORD_LETTERS, weights, k=length)))
+    return list(keys)
+
+
+def bytes_keys(rng, count):
+    """ Generate random binary keys, as latin-1 strings """
+
+    keys = set()
+    while len(keys) < count:
+        length = rng.randint(4, 16)
+        keys.add(bytes(rng.getrandbits(8) for _ in range(length))\
+                .decode('latin-1'))
+    return list(keys)
+
+
+KEY_SETS = {
+    'urls': url_keys,
+    'words': word_keys,
+    'bytes': bytes_keys,
+}
+
+
+def make_keys(kind, count, seed):
+    """ Return a reproducible shuffled list of count unique keys """
+
+    rng = random.Random('{}:{}:{}'.format(kind, count, seed))
+    keys = KEY_SETS[kind](rng, count)
+    keys.sort()
+    rng.shuffle(keys)
+    return keys
+
+
+def timed(function):
+    """ Return the time taken to call function, in seconds """
+
+    gc.collect()
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def peak_rss():
+    """ Return the peak resident set size of this process in bytes, or None.
+
+        This is a high water mark for the whole process, so it only ever
+        grows between runs; run() gives each benchmark its own process.
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak # Already in bytes.
+    return peak * 1024
+
+
+def traced_bytes(cls, keys):
+    """ Return the bytes allocated while building a trie of keys """
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        structure = cls()
+        for i, key in enumerate(keys):
+            structure[key] = i
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del structure
+    return current
+
+
+def bench(cls, keys):
+    """ Time each operation on a trie of the given keys.
+
+        Returns a dict of throughputs, in operations per second, and memory
+        measurements.
+    """
+
+    structure = cls()
+
+    def insert():
+        for i, key in enumerate(keys):
+            structure[key] = i
+
+    def lookup():
+        for key in keys:
+            structure[key]
+
+    def iterate():
+        for _ in structure:
+            pass
+
+    def delete():
+        for key in keys:
+            del structure[key]
+
+    count = len(keys)
+    result = {}
+    for name, function in (('insert', insert), ('lookup', lookup),
+            ('iterate', iterate), ('delete', delete)):
+        result[name + '_per_sec'] = count / timed(function)
+        if name == 'iterate':
+            result['bytes_per_key'] = structure.bytes_per_key()
+    result['traced_bytes_per_key'] = traced_bytes(cls, keys) / count
+    result['peak_rss'] = peak_rss()
+    return result
+
+
+def bench_keys(name, kind, size, seed):
+    """ Generate the given key set and benchmark the named implementation on
+        it, returning the result as for run.
+    """
+
+    result = {'keys': kind, 'size': size, 'implementation': name}
+    result.update(bench(IMPLEMENTATIONS[name], make_keys(kind, size, seed)))
+    return result
+
+
+def run(sizes, kinds, implementations, seed):
+    """ Run every benchmark combination, returning the list of results.
+
+        Each combination runs in a fresh process, so that peak_rss only
+        covers that benchmark.
+    """
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            for name in implementations:
+                with context.Pool(1) as pool:
+                    result = pool.apply(bench_keys, (name, kind, size, seed))
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def print_result(result):
+    """ Print a single benchmark result as a table row """
+
+    print("{keys:>6} {size:>8} {implementation:>12} "
+            "{insert_per_sec:>12.0f} {lookup_per_sec:>12.0f} "
+            "{iterate_per_sec:>12.0f} {delete_per_sec:>12.0f} "
+            "{bytes_per_key:>10.1f} {traced_bytes_per_key:>10.1f}"\
+            .format(**result), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+            default=DEFAULT_SIZES, help="number of keys in each key set")
+    parser.add_argument('--keys', nargs='+', choices=sorted(KEY_SETS),
+            default=sorted(KEY_SETS), help="key sets to generate")
+    parser.add_argument('--impl', nargs='+', choices=sorted(IMPLEMENTATIONS),
+            default=sorted(IMPLEMENTATIONS), help="implementations to test")
+    parser.add_argument('--seed', type=int, default=0,
+            help="seed for generating the key sets")
+    parser.add_argument('--json', metavar='PATH',
+            help="write the results as JSON to PATH")
+    args = parser.parse_args()
+
+    print("{:>6} {:>8} {:>12} {:>12} {:>12} {:>12} {:>12} {:>10} {:>10}"\
+            .format('keys', 'size', 'impl', 'insert/s', 'lookup/s',
+                'iterate/s', 'delete/s', 'bytes/key', 'traced/key'))
+    results = run(args.sizes, args.keys, args.impl, args.seed)
+
+    if args.json is not None:
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
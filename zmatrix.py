@@ -7,11 +7,41 @@
 """
 
 import math
+from itertools import chain
+
+try:
+    import numpy
+except ImportError: # Only used by to_cartesian_batch.
+    numpy = None
+
 sin = lambda deg: math.sin(math.radians(deg))
 cos = lambda deg: math.cos(math.radians(deg))
 acos = lambda ratio: math.degrees(math.acos(ratio))
 atan = lambda ratio: math.degrees(math.atan(ratio))
 
+# Dummy points used to place the first few atoms of a z-matrix.
+DUMMIES = {-1: (0, 0, 0), -2: (0, 0, -1), -3: (1, 0, 0)}
+# The NeRF placement measures dihedrals consistently, so it needs the third
+# dummy point on the other side to put the first atoms where _place does.
+NERF_DUMMIES = {-1: (0, 0, 0), -2: (0, 0, -1), -3: (-1, 0, 0)}
+
+# Covalent radii in angstroms, used to guess the bonds between atoms; two
+# atoms are bonded if they are within the sum of their radii plus
+# BOND_TOLERANCE.
+COVALENT_RADII = {'H': 0.31, 'B': 0.84, 'C': 0.76, 'N': 0.71, 'O': 0.66,
+        'F': 0.57, 'Si': 1.11, 'P': 1.07, 'S': 1.05, 'Cl': 1.02, 'Br': 1.20,
+        'I': 1.39}
+DEFAULT_RADIUS = 0.76
+BOND_TOLERANCE = 0.4
+
+# to_zmatrix prefers reference atoms which bend away from a line by at least
+# this much (the square of the sine of the angle), so that the dihedrals are
+# well defined.
+MIN_BEND = 0.1
+
+# Size of the buffer used by write_xyz_frames, in bytes.
+WRITE_BUFFER_SIZE = 1 << 20
+
 def polar_to_cartesian(angle, dihedral, length):
     """ Convert from polar angles in 3D to a cartesian offset.
 
@@ -144,8 +174,158 @@ def print_cartesian(atoms, coords, precision):
                     round(coords[number][2] + 10**(-precision - 2), precision)))
 
 
-def to_cartesian(zmat):
+def parse_line(line):
+    """ Parse a line of a z-matrix into (atom, references, values).
+
+        Each line in a z-matrix is of the form:
+        atom, first, distance, second, angle, third, dihedral
+        where first, second, third are the adjacent atoms, the atom
+        determining the angle, and a third atom determining the plane to
+        use when taking into account the dihedral. Missing fields default
+        to the dummy points and zero.
+
+        >>> parse_line("H 0 1 1 109")
+        ('H', (0, 1, -3), (1.0, 109.0, 0.0))
+    """
+
+    atom = [None, -1, 0, -2, 0, -3, 0] # Set default values.
+    for i, v in enumerate(line.split()):
+        atom[i] = v
+    return (atom[0], (int(atom[1]), int(atom[3]), int(atom[5])),
+            (float(atom[2]), float(atom[4]), float(atom[6])))
+
+
+def _place(first, second, third, distance, angle, dihedral):
+    """ Return the position of an atom the given distance from first, making
+        the given angle with second and dihedral with third.
+    """
+
+    # The general approach here is to start by assuming that the first
+    # point is at the origin, the second point is some negative distance 
+    # along the z-axis, and the third point is elsewhere in the x-z plane.
+    # This lets us place the new atom easily.
+    # From this we then apply transformations to actually move the other
+    # points so that they fit the above description, and the apply the
+    # inverse transformations in reverse order to the main point.
+    # This leaves us with a point in the correct position.
+
+    # Translate the new, second and third points so that they remain in the
+    # same place relative to the first, but the first is now at the origin.
+    second = [second[i] - first[i] for i in range(3)]
+    third = [third[i] - first[i] for i in range(3)]
+    translate = lambda pos: [pos[i] + first[i] for i in range(3)]
+
+    # Rotate the new, second and third points so that the second point is
+    # on the negative side of the z-axis (polar coordinates [180, 0, l]).
+    # The rotation needs to be distance and angle-preserving; to ensure
+    # that we always rotate through the dihedral first (a rotation around
+    # the z-axis) and then rotate around the y-axis using the angle, since
+    # the dihedral is 0 so the second point should now be on the x-z plane.
+    rotation = cartesian_to_polar(*second)
+    rotation[0] = 180 + rotation[0]
+    third_polar = cartesian_to_polar(*third)
+    third_polar[1] -= rotation[1]
+    third = polar_to_cartesian(*third_polar)
+    t0 = cos(-rotation[0]) * third[0] - sin(-rotation[0]) * third[2]
+    t2 = cos(-rotation[0]) * third[2] + sin(-rotation[0]) * third[0]
+    third[0] = t0
+    third[2] = t2
+    def rotate_angle(pos_polar):
+        pos_polar[1] += rotation[1]
+        pos = polar_to_cartesian(*pos_polar)
+        p0 = cos(rotation[0]) * pos[0] - sin(rotation[0]) * pos[2]
+        p2 = cos(rotation[0]) * pos[2] + sin(rotation[0]) * pos[0]
+        pos[0] = p0
+        pos[2] = p2
+        return pos
+
+    # Rotate the new and third points so that the third point is on the
+    # x-z plane. Fortunately this is relatively simple; we just need to
+    # set the dihedral to 0.
+    third_polar = cartesian_to_polar(*third)
+    def rotate_dihedral(pos_polar):
+        pos_polar[1] += third_polar[1]
+        return pos_polar
+
+    # Apply the accumulated transformations.
+    return translate(\
+            rotate_angle(\
+            rotate_dihedral([angle, dihedral, distance])))
+
+
+def _place_nerf(first, second, third, distance, angle, dihedral):
+    """ Place an atom as for _place, using the Natural Extension Reference
+        Frame method: the position is built directly in a local frame of
+        the bond from second to first, the normal to the plane of the three
+        reference points, and their cross product.
+
+        The angle is measured from the extension of the bond, as for
+        _place, and the dihedral is the usual torsion angle of third,
+        second, first and the new atom. If the reference points are in a
+        line any plane through the bond is used.
+
+        >>> [round(i, 2) for i in _place_nerf((0, 0, 0), (0, 0, 1),
+        ...         (-1, 0, 1), 1, 109, 120)]
+        [0.47, 0.82, 0.33]
+    """
+
+    # Unit vector along the bond.
+    bx = first[0] - second[0]
+    by = first[1] - second[1]
+    bz = first[2] - second[2]
+    length = math.sqrt(bx*bx + by*by + bz*bz)
+    bx, by, bz = bx / length, by / length, bz / length
+
+    # Unit normal to the plane of third, second and first.
+    ux = second[0] - third[0]
+    uy = second[1] - third[1]
+    uz = second[2] - third[2]
+    nx = uy*bz - uz*by
+    ny = uz*bx - ux*bz
+    nz = ux*by - uy*bx
+    length = math.sqrt(nx*nx + ny*ny + nz*nz)
+    if length < 1e-12 * (1 + math.sqrt(ux*ux + uy*uy + uz*uz)):
+        # Pick the axis least parallel to the bond to find a normal.
+        if abs(bx) < 0.9:
+            nx, ny, nz = 0, bz, -by
+        else:
+            nx, ny, nz = -bz, 0, bx
+        length = math.sqrt(nx*nx + ny*ny + nz*nz)
+    nx, ny, nz = nx / length, ny / length, nz / length
+
+    # Completes the frame, pointing from the bond towards third.
+    mx = ny*bz - nz*by
+    my = nz*bx - nx*bz
+    mz = nx*by - ny*bx
+
+    angle = math.radians(angle)
+    dihedral = math.radians(dihedral)
+    along = distance * math.cos(angle)
+    across = distance * math.sin(angle)
+    x = across * math.cos(dihedral)
+    y = across * math.sin(dihedral)
+    return [first[0] + along*bx + x*mx + y*nx,
+            first[1] + along*by + x*my + y*ny,
+            first[2] + along*bz + x*mz + y*nz]
+
+
+# Placement functions and the dummy points they use, by method name.
+METHODS = {
+    'polar': (_place, DUMMIES),
+    'nerf': (_place_nerf, NERF_DUMMIES),
+}
+
+
+def to_cartesian(zmat, method='polar'):
     """ Convert the given z-matrix to cartesian coordinates.
+
+        method selects how each atom is placed. 'polar' rotates the
+        reference points onto the axes through polar coordinates. 'nerf'
+        uses _place_nerf instead, which is over twice as fast and keeps
+        the angles and dihedrals exact for reference atoms in any
+        orientation, not just along the axes. The two give the same
+        positions for the examples below, except that the polar method
+        measures the dihedrals in the last few the other way around.
     
         >>> atoms, coords = to_cartesian("O")
         >>> print_cartesian(atoms, coords, 2)
@@ -211,91 +391,650 @@ def to_cartesian(zmat):
         O 0.0 0.0 1.0
         O -1.0 0.0 0.0
         H 0.71 0.71 1.0
+        >>> atoms, coords = to_cartesian("C\\nH 0 1\\nH 0 1 1 109\\nH 0 1 1 109 2 120\\nH 0 1 1 109 2 -120", method='nerf')
+        >>> print_cartesian(atoms, coords, 2)
+        C 0.0 0.0 0.0
+        H 0.0 0.0 1.0
+        H -0.95 0.0 0.33
+        H 0.47 0.82 0.33
+        H 0.47 -0.82 0.33
+        >>> atoms, coords = to_cartesian("O\\nO 0 1\\nO 0 1 1 90\\nH 1 1 0 90 2 45", method='nerf')
+        >>> print_cartesian(atoms, coords, 2)
+        O 0.0 0.0 0.0
+        O 0.0 0.0 1.0
+        O -1.0 0.0 0.0
+        H -0.71 -0.71 1.0
     """
 
+    if method not in METHODS:
+        raise ValueError("Unknown method {}".format(method))
+    place, dummies = METHODS[method]
+
     # Initialise with dummy points; these are used to place the first few
     # atoms.
-    coords = {-1: (0, 0, 0), -2: (0, 0, -1), -3: (1, 0, 0)}
+    coords = dict(dummies)
     atoms = {}
 
-    # Parse the z-matrix.
     for number, line in enumerate(zmat.splitlines()):
-        # Each line in a z-matrix is of the form:
-        # atom, first, distance, second, angle, third, dihedral
-        # where first, second, third are the adjacent atoms, the atom
-        # determining the angle, and a third atom determining the plane to
-        # use when taking into account the dihedral.
-
-        # Parse the line into the fields.
-        atom = [None, -1, 0, -2, 0, -3, 0] # Set default values.
-        for i, v in enumerate(line.split()):
-            atom[i] = v
-        name = atom[0]
-        first = coords[int(atom[1])]
-        distance = float(atom[2])
-        second = coords[int(atom[3])]
-        angle = float(atom[4])
-        third = coords[int(atom[5])]
-        dihedral = float(atom[6])
-
-        # The general approach here is to start by assuming that the first
-        # point is at the origin, the second point is some negative distance 
-        # along the z-axis, and the third point is elsewhere in the x-z plane.
-        # This lets us place the new atom easily.
-        # From this we then apply transformations to actually move the other
-        # points so that they fit the above description, and the apply the
-        # inverse transformations in reverse order to the main point.
-        # This leaves us with a point in the correct position.
-
-        # Translate the new, second and third points so that they remain in the
-        # same place relative to the first, but the first is now at the origin.
-        second = [second[i] - first[i] for i in range(3)]
-        third = [third[i] - first[i] for i in range(3)]
-        translate = lambda pos: [pos[i] + first[i] for i in range(3)]
-
-        # Rotate the new, second and third points so that the second point is
-        # on the negative side of the z-axis (polar coordinates [180, 0, l]).
-        # The rotation needs to be distance and angle-preserving; to ensure
-        # that we always rotate through the dihedral first (a rotation around
-        # the z-axis) and then rotate around the y-axis using the angle, since
-        # the dihedral is 0 so the second point should now be on the x-z plane.
-        rotation = cartesian_to_polar(*second)
-        rotation[0] = 180 + rotation[0]
-        third_polar = cartesian_to_polar(*third)
-        third_polar[1] -= rotation[1]
-        third = polar_to_cartesian(*third_polar)
-        t0 = cos(-rotation[0]) * third[0] - sin(-rotation[0]) * third[2]
-        t2 = cos(-rotation[0]) * third[2] + sin(-rotation[0]) * third[0]
-        third[0] = t0
-        third[2] = t2
-        def rotate_angle(pos_polar):
-            pos_polar[1] += rotation[1]
-            pos = polar_to_cartesian(*pos_polar)
-            p0 = cos(rotation[0]) * pos[0] - sin(rotation[0]) * pos[2]
-            p2 = cos(rotation[0]) * pos[2] + sin(rotation[0]) * pos[0]
-            pos[0] = p0
-            pos[2] = p2
-            return pos
-
-        # Rotate the new and third points so that the third point is on the
-        # x-z plane. Fortunately this is relatively simple; we just need to
-        # set the dihedral to 0.
-        third_polar = cartesian_to_polar(*third)
-        def rotate_dihedral(pos_polar):
-            pos_polar[1] += third_polar[1]
-            return pos_polar
-
-        # Apply the accumulated transformations.
-        pos = translate(\
-                rotate_angle(\
-                rotate_dihedral([angle, dihedral, distance])))
-
+        name, references, values = parse_line(line)
+        first, second, third = (coords[i] for i in references)
         atoms[number] = name
-        coords[number] = pos
+        coords[number] = place(first, second, third, *values)
 
     return atoms, coords
 
 
+def covalent_radius(name):
+    """ Return the covalent radius for the atom with the given name, which
+        may be followed by a number, such as 'C12'.
+
+        >>> covalent_radius('Cl2'), covalent_radius('CL'), covalent_radius('X')
+        (1.02, 1.02, 0.76)
+    """
+
+    element = ''.join(c for c in name if c.isalpha()).capitalize()
+    return COVALENT_RADII.get(element, DEFAULT_RADIUS)
+
+
+# Offsets to the neighbouring cells used by bond_graph, including the cell
+# itself, which come after it in lexicographic order.
+_HALF_SHELL = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) \
+        for dz in (-1, 0, 1) if (dx, dy, dz) >= (0, 0, 0)]
+
+
+def bond_graph(atoms, coords):
+    """ Return a dict mapping each atom number to a list of the atoms it is
+        bonded to, nearest first.
+
+        The atoms are sorted into a grid of cells as wide as the longest
+        possible bond, so only atoms in neighbouring cells are compared and
+        this takes time linear in the number of atoms.
+
+        >>> atoms = {0: 'O', 1: 'H', 2: 'H'}
+        >>> coords = {0: (0, 0, 0), 1: (0.76, 0.59, 0), 2: (-0.76, 0.59, 0)}
+        >>> bond_graph(atoms, coords)
+        {0: [1, 2], 1: [0], 2: [0]}
+    """
+
+    numbers = [number for number in atoms if number >= 0]
+    if not numbers:
+        return {}
+    # Half the tolerance is added to each radius, so that two atoms are
+    # bonded if they are within the sum of their reaches.
+    reaches = {number: covalent_radius(atoms[number]) + BOND_TOLERANCE / 2 \
+            for number in numbers}
+    size = 2 * max(reaches.values())
+
+    cells = {}
+    for number in numbers:
+        x, y, z = coords[number]
+        cell = (math.floor(x / size), math.floor(y / size),
+                math.floor(z / size))
+        cells.setdefault(cell, []).append((number, x, y, z, reaches[number]))
+
+    # Compare each cell with itself and the half of its neighbours which
+    # come after it, so that each pair of cells is only compared once.
+    bonds = {number: [] for number in numbers}
+    for (cx, cy, cz), members in cells.items():
+        for dx, dy, dz in _HALF_SHELL:
+            others = cells.get((cx + dx, cy + dy, cz + dz))
+            if others is None:
+                continue
+            same = others is members
+            for j, (number, x, y, z, reach) in enumerate(members):
+                for other, ox, oy, oz, other_reach in \
+                        members[j + 1:] if same else others:
+                    square = (x - ox)**2 + (y - oy)**2 + (z - oz)**2
+                    if square <= (reach + other_reach)**2:
+                        distance = math.sqrt(square)
+                        bonds[number].append((distance, other))
+                        bonds[other].append((distance, number))
+    return {number: [other for _, other in sorted(bonded)] \
+            for number, bonded in bonds.items()}
+
+
+def _internal(first, second, third, pos):
+    """ Return the distance, angle and dihedral placing pos relative to the
+        reference points, as for _place_nerf. The angle and dihedral are 0
+        where they are not defined.
+    """
+
+    ux, uy, uz = (pos[i] - first[i] for i in range(3))
+    vx, vy, vz = (second[i] - first[i] for i in range(3))
+    distance = math.sqrt(ux*ux + uy*uy + uz*uz)
+    bond = math.sqrt(vx*vx + vy*vy + vz*vz)
+    if distance == 0 or bond == 0:
+        return distance, 0.0, 0.0
+    # atan2 is accurate for angles near 0 and 180, unlike acos.
+    cross = math.sqrt((uy*vz - uz*vy)**2 + (uz*vx - ux*vz)**2 + \
+            (ux*vy - uy*vx)**2)
+    angle = 180 - math.degrees(math.atan2(cross, ux*vx + uy*vy + uz*vz))
+
+    # The torsion angle of third, second, first and pos, about the bond.
+    bx, by, bz = -vx / bond, -vy / bond, -vz / bond
+    wx, wy, wz = (third[i] - second[i] for i in range(3))
+    along = wx*bx + wy*by + wz*bz
+    wx, wy, wz = wx - along*bx, wy - along*by, wz - along*bz
+    along = ux*bx + uy*by + uz*bz
+    ux, uy, uz = ux - along*bx, uy - along*by, uz - along*bz
+    x = wx*ux + wy*uy + wz*uz
+    y = (by*wz - bz*wy)*ux + (bz*wx - bx*wz)*uy + (bx*wy - by*wx)*uz
+    dihedral = math.degrees(math.atan2(y, x)) if x or y else 0.0
+    return distance, angle, dihedral
+
+
+def _bend(a, b, c):
+    """ Return the square of the sine of the angle between the lines from a
+        to b and from b to c, or 0 if the points are (nearly) in a line.
+    """
+
+    ux, uy, uz = (b[i] - a[i] for i in range(3))
+    vx, vy, vz = (c[i] - b[i] for i in range(3))
+    cross = (uy*vz - uz*vy)**2 + (uz*vx - ux*vz)**2 + (ux*vy - uy*vx)**2
+    lengths = (ux*ux + uy*uy + uz*uz) * (vx*vx + vy*vy + vz*vz)
+    if cross <= 1e-12 * lengths:
+        return 0.0
+    return cross / lengths
+
+
+def to_zmatrix(atoms, coords, precision=6):
+    """ Convert the given atoms and cartesian coordinates, as returned by
+        to_cartesian, to a z-matrix with the values rounded to the given
+        number of decimal places.
+
+        The atoms keep their order, and are numbered from 0 in the z-matrix.
+        Each is placed relative to the nearest earlier atom it is bonded
+        to, and then to atoms bonded to that where possible, as found by
+        bond_graph. The result gives back the same geometry, up to a
+        rotation and translation, with to_cartesian(zmat, method='nerf').
+
+        >>> atoms = {0: 'O', 1: 'H', 2: 'H'}
+        >>> coords = {0: (0, 0, 0), 1: (0.76, 0.59, 0), 2: (-0.76, 0.59, 0)}
+        >>> print(to_zmatrix(atoms, coords, 2))
+        O
+        H 0 0.96
+        H 0 0.96 1 75.65
+        >>> zmat = "C\\nH 0 1.09\\nH 0 1.09 1 70.5\\nH 0 1.09 1 70.5 2 120\\nH 0 1.09 1 70.5 2 -120"
+        >>> atoms, coords = to_cartesian(zmat, method='nerf')
+        >>> print(to_zmatrix(atoms, coords, 2))
+        C
+        H 0 1.09
+        H 0 1.09 1 70.5
+        H 0 1.09 1 70.5 2 120.0
+        H 0 1.09 1 70.5 2 -120.0
+    """
+
+    numbers = sorted(number for number in atoms if number >= 0)
+    index = {number: i for i, number in enumerate(numbers)}
+    bonds = bond_graph(atoms, coords)
+    lines = []
+    for i, number in enumerate(numbers):
+        # The candidate references are the earlier atoms bonded to this one
+        # or to its other references, nearest first, followed by all of the
+        # earlier atoms, working back from this one.
+        earlier = lambda atom: [c for c in bonds[atom] if index[c] < i]
+        previous = lambda: (numbers[j] for j in range(i - 1, -1, -1))
+
+        references = []
+        if i > 0:
+            first = next(iter(earlier(number)), numbers[i - 1])
+            references.append(first)
+        if i > 1:
+            candidates = chain(earlier(first), earlier(number), previous())
+            second = next(c for c in candidates if c != first)
+            references.append(second)
+        if i > 2:
+            # Any atom off the line through first and second fixes the
+            # plane of the dihedral, but one well off the line gives the
+            # most accurate dihedral. If there are none, all of the earlier
+            # atoms are in a line and any dihedral will do.
+            third, best = None, -1
+            candidates = chain(earlier(second), earlier(first),
+                    earlier(number), previous())
+            for tried, c in enumerate(candidates):
+                if c == first or c == second:
+                    continue
+                bend = _bend(coords[c], coords[second], coords[first])
+                if bend > best:
+                    third, best = c, bend
+                # Stop at a well-defined plane, or a usable one once a few
+                # atoms have been tried.
+                if best > MIN_BEND or best > 0 and tried >= 16:
+                    break
+            references.append(third)
+
+        # Atoms without all three references are placed using the dummy
+        # points, but the values for them aren't written out.
+        points = [coords[c] for c in references] + \
+                [NERF_DUMMIES[n] for n in (-1, -2, -3)][len(references):]
+        values = _internal(points[0], points[1], points[2], coords[number])
+        fields = [atoms[number]]
+        for reference, value in zip(references, values):
+            fields.append(str(index[reference]))
+            fields.append(str(round(value, precision)))
+        lines.append(' '.join(fields))
+    return '\n'.join(lines)
+
+
+def iter_zmatrix_frames(path, method='polar'):
+    """ Lazily read a trajectory of z-matrices, separated by blank lines,
+        from the file at path, yielding each frame as to_cartesian would
+        convert it. Lines starting with '#' are skipped.
+
+        Only one frame is read and converted at a time, so this works for
+        trajectories much larger than memory.
+
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'scan.zmat')
+        >>> with open(path, 'w') as f:
+        ...     _ = f.write("# A bond scan.\\nO\\nH 0 1\\n\\nO\\nH 0 2\\n")
+        >>> for atoms, coords in iter_zmatrix_frames(path):
+        ...     print_cartesian(atoms, coords, 2)
+        O 0.0 0.0 0.0
+        H 0.0 0.0 1.0
+        O 0.0 0.0 0.0
+        H 0.0 0.0 2.0
+        >>> os.remove(path)
+    """
+
+    with open(path) as f:
+        lines = []
+        for line in f:
+            if line.startswith('#'):
+                continue
+            if line.strip():
+                lines.append(line)
+            elif lines:
+                yield to_cartesian(''.join(lines), method)
+                lines = []
+        if lines:
+            yield to_cartesian(''.join(lines), method)
+
+
+def iter_xyz_frames(path):
+    """ Lazily read the frames of an XYZ trajectory file at path, yielding
+        (atoms, coords) for each as for to_cartesian.
+
+        Each frame is the number of atoms, a comment line, and then a line
+        "atom x y z" for each atom.
+    """
+
+    with open(path) as f:
+        for header in f:
+            if not header.strip():
+                continue
+            count = int(header)
+            lines = [f.readline() for _ in range(count + 1)][1:]
+            if count and not lines[-1]:
+                raise ValueError("{}: the last frame is truncated"\
+                        .format(path))
+            atoms, coords = {}, {}
+            for number, line in enumerate(lines):
+                name, x, y, z = line.split()[:4]
+                atoms[number] = name
+                coords[number] = (float(x), float(y), float(z))
+            yield atoms, coords
+
+
+def write_xyz_frames(path, frames, precision=6):
+    """ Write the given (atoms, coords) frames to the file at path in XYZ
+        format, with the coordinates to the given number of decimal places.
+        Each comment line is the number of the frame.
+
+        frames may be any iterable, such as from iter_zmatrix_frames; it is
+        consumed lazily and each frame is formatted and written as a single
+        block through a large buffer.
+
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'scan.xyz')
+        >>> zmats = ("O\\nH 0 1\\nH 0 1 1 {}".format(a) for a in (90, 109))
+        >>> write_xyz_frames(path, (to_cartesian(z) for z in zmats), 2)
+        >>> print(open(path).read().strip())
+        3
+        0
+        O 0.00 0.00 0.00
+        H 0.00 0.00 1.00
+        H -1.00 0.00 0.00
+        3
+        1
+        O 0.00 0.00 0.00
+        H 0.00 0.00 1.00
+        H -0.95 0.00 0.33
+        >>> [atoms[2] for atoms, coords in iter_xyz_frames(path)]
+        ['H', 'H']
+        >>> os.remove(path)
+    """
+
+    row = '{{}} {{:.{0}f}} {{:.{0}f}} {{:.{0}f}}\n'.format(precision)
+    with open(path, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+        for index, (atoms, coords) in enumerate(frames):
+            numbers = sorted(number for number in atoms if number >= 0)
+            block = ['{}\n{}\n'.format(len(numbers), index)]
+            for number in numbers:
+                x, y, z = coords[number]
+                # Adding 0.0 turns -0.0 into 0.0.
+                block.append(row.format(atoms[number], x + 0.0, y + 0.0,
+                    z + 0.0))
+            f.write(''.join(block))
+
+
+class ZMatrixModel:
+    """ A z-matrix with its cartesian coordinates, kept up to date as the
+        internal coordinates are changed, as in a dihedral scan.
+
+        The atoms are placed with _place_nerf, and the model records which
+        atoms refer to each one, so a change only moves the atoms which
+        depend on it. Where they only refer to each other and the bond
+        being rotated about, they move as a rigid body and are just rotated.
+
+        >>> zmat = "C\\nC 0 1.54\\nC 1 1.54 0 70.5\\nC 2 1.54 1 70.5 0 180\\nH 3 1.09 2 70.5 1 60\\nH 2 1.09 1 70.5 0 60"
+        >>> model = ZMatrixModel(zmat)
+        >>> model.set_dihedral(3, 60)
+        >>> print(model.zmatrix())
+        C
+        C 0 1.54
+        C 1 1.54 0 70.5
+        C 2 1.54 1 70.5 0 60
+        H 3 1.09 2 70.5 1 60.0
+        H 2 1.09 1 70.5 0 60.0
+        >>> atoms, coords = to_cartesian(model.zmatrix(), method='nerf')
+        >>> max(abs(coords[i][j] - model.coords[i][j]) \\
+        ...         for i in atoms for j in range(3)) < 1e-9
+        True
+    """
+
+    def __init__(self, zmat):
+        self.atoms = {}
+        self.references = []
+        self.values = []
+        self._fields = []
+        # Atoms which refer to each atom, and the cached lists of the atoms
+        # which depend on each atom, directly or not, and of how they move.
+        self._referrers = {}
+        self._downstream = {}
+        self._plans = {}
+
+        for number, line in enumerate(zmat.splitlines()):
+            name, references, values = parse_line(line)
+            self.atoms[number] = name
+            self.references.append(references)
+            self.values.append(list(values))
+            self._fields.append(len(line.split()))
+            self._referrers[number] = []
+            for reference in set(references):
+                if reference >= 0:
+                    self._referrers[reference].append(number)
+
+        self.coords = dict(NERF_DUMMIES)
+        for number, references in enumerate(self.references):
+            self.coords[number] = _place_nerf(
+                    *(self.coords[i] for i in references),
+                    *self.values[number])
+
+    def __len__(self):
+        return len(self.atoms)
+
+    def downstream(self, number):
+        """ Return a sorted list of the atoms placed relative to the given
+            atom, directly or through other atoms.
+        """
+
+        if number not in self._downstream:
+            found = set()
+            stack = [number]
+            while stack:
+                for referrer in self._referrers[stack.pop()]:
+                    if referrer not in found:
+                        found.add(referrer)
+                        stack.append(referrer)
+            self._downstream[number] = sorted(found)
+        return self._downstream[number]
+
+    def _plan(self, number):
+        """ Return the atoms which move when the dihedral of the given atom
+            changes, in order, each paired with whether it turns rigidly.
+        """
+
+        if number not in self._plans:
+            first, second, _ = self.references[number]
+            rigid = {number, first, second}
+            plan = [(number, True)]
+            for atom in self.downstream(number):
+                moves = all(i in rigid for i in self.references[atom])
+                if moves:
+                    rigid.add(atom)
+                plan.append((atom, moves))
+            self._plans[number] = plan
+        return self._plans[number]
+
+    def set_dihedral(self, number, value):
+        """ Set the dihedral of the given atom, moving it and the atoms that
+            depend on it.
+
+            The atom turns about the bond from its second reference to its
+            first, and so does every dependent atom whose references all
+            turn with it or are on that bond. Any others are placed again
+            from their references.
+
+            Only atoms with a dihedral to another atom can be changed:
+
+            >>> ZMatrixModel("C\\nC 0 1\\nC 1 1 0 90").set_dihedral(2, 45)
+            Traceback (most recent call last):
+                ...
+            ValueError: Atom 2 has no dihedral to set
+        """
+
+        first, second, third = self.references[number]
+        if self._fields[number] < 7 or third < 0:
+            raise ValueError("Atom {} has no dihedral to set".format(number))
+        change = math.radians(value - self.values[number][2])
+        self.values[number][2] = value
+        if change == 0:
+            return
+
+        # Rotate about the bond with Rodrigues' formula, as a matrix.
+        origin = self.coords[first]
+        ax, ay, az = (origin[i] - self.coords[second][i] for i in range(3))
+        length = math.sqrt(ax*ax + ay*ay + az*az)
+        ax, ay, az = ax / length, ay / length, az / length
+        c, s = math.cos(change), math.sin(change)
+        t = 1 - c
+        rotation = ((t*ax*ax + c, t*ax*ay - s*az, t*ax*az + s*ay),
+                (t*ax*ay + s*az, t*ay*ay + c, t*ay*az - s*ax),
+                (t*ax*az - s*ay, t*ay*az + s*ax, t*az*az + c))
+
+        ox, oy, oz = origin
+        (r00, r01, r02), (r10, r11, r12), (r20, r21, r22) = rotation
+        coords = self.coords
+        for atom, moves in self._plan(number):
+            if moves:
+                x, y, z = coords[atom]
+                x, y, z = x - ox, y - oy, z - oz
+                coords[atom] = [r00*x + r01*y + r02*z + ox,
+                        r10*x + r11*y + r12*z + oy,
+                        r20*x + r21*y + r22*z + oz]
+            else:
+                coords[atom] = _place_nerf(
+                        *(coords[i] for i in self.references[atom]),
+                        *self.values[atom])
+
+    def zmatrix(self):
+        """ Return the current z-matrix, with the same fields as the one the
+            model was made from.
+        """
+
+        lines = []
+        for number, references in enumerate(self.references):
+            fields = [self.atoms[number]]
+            for reference, value in zip(references, self.values[number]):
+                fields.append(str(reference))
+                fields.append(str(value))
+            lines.append(' '.join(fields[:self._fields[number]]))
+        return '\n'.join(lines)
+
+
+def to_cartesian_batch(zmats, method='polar'):
+    """ Convert many z-matrices with the same atoms and references, such as
+        conformers of one molecule, to cartesian coordinates.
+
+        Returns (atoms, coords) where atoms is as for to_cartesian and
+        coords[conformer][atom] is the position of the atom in the given
+        conformer. With NumPy, coords is a (conformers, atoms, 3) array and
+        each atom is placed in every conformer at once; without it the
+        conformers are converted one at a time into nested lists. method is
+        as for to_cartesian.
+
+        >>> zmats = ["O\\nH 0 1\\nH 0 1 1 {}".format(angle) \\
+        ...         for angle in (90, 109, 150)]
+        >>> atoms, coords = to_cartesian_batch(zmats)
+        >>> atoms
+        {0: 'O', 1: 'H', 2: 'H'}
+        >>> [[round(float(i), 2) for i in coords[c][2]] for c in range(3)]
+        [[-1.0, 0.0, 0.0], [-0.95, 0.0, 0.33], [-0.5, 0.0, 0.87]]
+        >>> to_cartesian_batch(["O\\nH 0 1", "O\\nO 0 1"])
+        Traceback (most recent call last):
+        ...
+        ValueError: Z-matrix 1 does not match the first
+    """
+
+    if method not in METHODS:
+        raise ValueError("Unknown method {}".format(method))
+    place, dummies = METHODS[method]
+
+    atoms = None
+    values = []
+    for index, zmat in enumerate(zmats):
+        lines = [parse_line(line) for line in zmat.splitlines()]
+        topology = [(name, references) for name, references, _ in lines]
+        if atoms is None:
+            atoms = topology
+        elif topology != atoms:
+            raise ValueError("Z-matrix {} does not match the first"\
+                    .format(index))
+        values.append([line_values for _, _, line_values in lines])
+    if atoms is None:
+        return {}, []
+
+    if numpy is None:
+        coords = []
+        for conformer in values:
+            positions = dict(dummies)
+            for number, (name, references) in enumerate(atoms):
+                first, second, third = (positions[i] for i in references)
+                positions[number] = place(first, second, third,
+                        *conformer[number])
+            coords.append([positions[number] for number in range(len(atoms))])
+    else:
+        values = numpy.array(values, dtype=float).reshape(len(values), -1, 3)
+        # The dummy points go at the end, so that the negative references
+        # index them directly.
+        coords = numpy.empty((len(values), len(atoms) + 3, 3))
+        for number, position in dummies.items():
+            coords[:, number] = position
+        place = _BATCH_METHODS[method]
+        for number, (name, references) in enumerate(atoms):
+            first, second, third = (coords[:, i] for i in references)
+            coords[:, number] = place(first, second, third,
+                    *values[:, number].T)
+        coords = coords[:, :len(atoms)]
+
+    return dict(enumerate(name for name, _ in atoms)), coords
+
+
+def _polar_to_cartesian_batch(angle, dihedral, length):
+    """ Vectorised polar_to_cartesian, returning the x, y and z arrays """
+
+    angle = numpy.radians(angle)
+    dihedral = numpy.radians(dihedral)
+    xy_distance = numpy.sin(angle) * length
+    return (numpy.cos(dihedral) * xy_distance,
+            numpy.sin(dihedral) * xy_distance,
+            numpy.cos(angle) * length)
+
+
+def _cartesian_to_polar_batch(x, y, z):
+    """ Vectorised cartesian_to_polar, returning the angle, dihedral and
+        length arrays.
+    """
+
+    length = numpy.sqrt(x*x + y*y + z*z)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        angle = numpy.where(z != 0,
+                numpy.degrees(numpy.arccos(numpy.clip(z / length, -1, 1))),
+                90.0)
+        dihedral = numpy.where(x != 0, numpy.degrees(numpy.arctan(y / x)),
+                numpy.sign(y) * 90.0)
+    angle = numpy.where(x < 0, -angle, angle)
+    zero = length == 0
+    return (numpy.where(zero, 0.0, angle), numpy.where(zero, 0.0, dihedral),
+            length)
+
+
+def _place_batch(first, second, third, distance, angle, dihedral):
+    """ Vectorised _place, for (n, 3) arrays of points and arrays of n
+        distances, angles and dihedrals.
+    """
+
+    second = second - first
+    third = third - first
+
+    # See _place for the transformations used.
+    rotation_angle, rotation_dihedral, _ = \
+            _cartesian_to_polar_batch(*second.T)
+    rotation_angle = 180 + rotation_angle
+    third_angle, third_dihedral, third_length = \
+            _cartesian_to_polar_batch(*third.T)
+    t0, t1, t2 = _polar_to_cartesian_batch(third_angle,
+            third_dihedral - rotation_dihedral, third_length)
+    turn = numpy.radians(-rotation_angle)
+    t0, t2 = (numpy.cos(turn) * t0 - numpy.sin(turn) * t2,
+            numpy.cos(turn) * t2 + numpy.sin(turn) * t0)
+    _, third_dihedral, _ = _cartesian_to_polar_batch(t0, t1, t2)
+
+    p0, p1, p2 = _polar_to_cartesian_batch(angle,
+            dihedral + third_dihedral + rotation_dihedral, distance)
+    turn = numpy.radians(rotation_angle)
+    p0, p2 = (numpy.cos(turn) * p0 - numpy.sin(turn) * p2,
+            numpy.cos(turn) * p2 + numpy.sin(turn) * p0)
+    return numpy.stack((p0, p1, p2), axis=-1) + first
+
+
+def _place_nerf_batch(first, second, third, distance, angle, dihedral):
+    """ Vectorised _place_nerf, with arguments as for _place_batch """
+
+    bond = first - second
+    bond /= numpy.linalg.norm(bond, axis=-1, keepdims=True)
+    plane = second - third
+    normal = numpy.cross(plane, bond)
+    length = numpy.linalg.norm(normal, axis=-1)
+    line = length < 1e-12 * (1 + numpy.linalg.norm(plane, axis=-1))
+    if line.any():
+        # See _place_nerf for the normal used for points in a line.
+        b = bond[line]
+        zero = numpy.zeros(len(b))
+        normal[line] = numpy.where((numpy.abs(b[:, 0]) < 0.9)[:, None],
+                numpy.stack((zero, b[:, 2], -b[:, 1]), axis=-1),
+                numpy.stack((-b[:, 2], zero, b[:, 0]), axis=-1))
+        length[line] = numpy.linalg.norm(normal[line], axis=-1)
+    normal /= length[:, None]
+    towards = numpy.cross(normal, bond)
+
+    angle = numpy.radians(angle)
+    dihedral = numpy.radians(dihedral)
+    along = distance * numpy.cos(angle)
+    across = distance * numpy.sin(angle)
+    return first + along[:, None] * bond + \
+            (across * numpy.cos(dihedral))[:, None] * towards + \
+            (across * numpy.sin(dihedral))[:, None] * normal
+
+
+# Vectorised placement functions, by method name.
+_BATCH_METHODS = {
+    'polar': _place_batch,
+    'nerf': _place_nerf_batch,
+}
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()